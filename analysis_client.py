@@ -0,0 +1,71 @@
+import config as cfg
+import json
+import os
+import socket
+
+
+'''
+AnalysisClient class sends analysis requests to a running AnalysisService over its Unix socket. It only needs the
+standard library, so the lab tools using it start instantly and get cached results back without loading NumPy or
+Pillow, or processing any image themselves.
+'''
+class AnalysisClient():
+
+    # Initialize AnalysisClient object, connecting to the service
+    # Parameters:
+    # socket_path: path of the Unix socket the service listens on
+    # timeout: max number of seconds to wait for a response, no limit if None
+    def __init__(self, socket_path=cfg.SERVICE_SOCKET_PATH, timeout=None):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        self.sock.connect(socket_path)
+        self.file = self.sock.makefile("rwb")
+        self.next_id = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    # Close the connection to the service
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+    # Send a request and wait for its response
+    # Parameters:
+    # request: the request dict, see AnalysisService
+    def request(self, request):
+        request = dict(request, id=self.next_id)
+        self.next_id += 1
+        self.file.write(json.dumps(request).encode() + b"\n")
+        self.file.flush()
+        line = self.file.readline()
+        if not line:
+            raise ConnectionError("The analysis service closed the connection")
+        response = json.loads(line)
+        if response.get("id") != request["id"]:
+            raise ConnectionError("Response to another request received from the analysis service")
+        if "error" in response:
+            raise RuntimeError(f"Analysis service error: {response['error']}")
+        del response["id"]
+        return response
+
+    # Analyse a parasite
+    # Parameters:
+    # body_img_path, veins_img_path: paths to the body and veins image files
+    # codec: name of the MicroImage processing technique to use (e.g. "scanlines", "bitmap")
+    # mode: see Parasite
+    # veins_codec: name of the MicroImage processing technique to use for the veins, if different from the body's
+    # Returns a dict of the veins_body_frac, veins_body_frac_bounds and has_cancer of the parasite
+    def analyse(self, body_img_path, veins_img_path, codec="scanlines", mode="exact", veins_codec=None):
+        if veins_codec not in (None, codec, "sparse"): # same pairings as Parasite.check_codecs, without importing it
+            raise ValueError(f"{veins_codec} veins can't be analysed with a {codec} body, use {codec} or sparse veins")
+        return self.request({"op": "analyse", "body_img_path": os.path.abspath(body_img_path),
+                             "veins_img_path": os.path.abspath(veins_img_path), "codec": codec, "mode": mode,
+                             "veins_codec": veins_codec})
+
+    # Get the counters of the service (requests, cache hits, coalesced requests, batches...)
+    def stats(self):
+        return self.request({"op": "stats"})
@@ -0,0 +1,292 @@
+from micro_image_large import ScanLinesMicroImage, BitMapMicroImage, CODECS
+from parasite import Parasite
+from parasite_batch import ParasiteBatch
+import config as cfg
+import asyncio
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import json
+import os
+import signal
+import socket
+
+
+# Read and process an image file. Runs in the worker processes of the analysis service
+# Parameters:
+# path: path to the image file
+# codec: name of the MicroImage processing technique
+def _encode_image(path, codec):
+    return CODECS[codec](path).processed
+
+# Veins-to-body fractions of a batch of parasites. Runs in the worker processes of the analysis service
+# Parameters:
+# pairs: list of (body processed image, veins processed image)
+# codec: name of the MicroImage processing technique of all the images
+def _calc_batch(pairs, codec):
+    return ParasiteBatch(pairs, CODECS[codec]).veins_body_frac
+
+# Analyse a single parasite from its processed images, for the modes and codecs ParasiteBatch doesn't handle. Runs in
+# the worker processes of the analysis service
+# Parameters:
+# body_processed, veins_processed: the processed body and veins images
+# codec, veins_codec: names of the MicroImage processing techniques of the body and veins
+# mode: see Parasite
+def _analyse_one(body_processed, veins_processed, codec, veins_codec, mode):
+    par = Parasite.from_micro_images("service", CODECS[codec].from_processed(body_processed),
+                                     CODECS[veins_codec].from_processed(veins_processed), mode)
+    bounds = par.veins_body_frac_bounds
+    return {"veins_body_frac": None if par.veins_body_frac is None else float(par.veins_body_frac),
+            "veins_body_frac_bounds": None if bounds is None else [float(bound) for bound in bounds],
+            "has_cancer": bool(par.has_cancer())}
+
+'''
+AnalysisService class is a long-lived local server that analyses parasites for the lab tools, over a Unix socket (see
+AnalysisClient). The processed images of the files it has seen are kept in an in-memory LRU cache, as well as the
+analysis results, so repeated requests don't read or process the files again. Identical concurrent requests (and
+requests sharing an image) are coalesced into one computation, images are processed and analysed in a pool of worker
+processes so the event loop stays responsive, and exact ScanLines / BitMap analyses arriving within cfg.SERVICE_BATCH_WINDOW_SECS of
+each other are computed together with ParasiteBatch.
+Protocol: one JSON object per line each way. Requests are {"id": ..., "op": "analyse", "body_img_path": ...,
+"veins_img_path": ..., "codec": ..., "mode": ..., "veins_codec": ...} or {"id": ..., "op": "stats"}, and every response
+carries the id of its request, and either the result or an "error".
+'''
+class AnalysisService():
+
+    # Initialize AnalysisService object
+    # Parameters:
+    # socket_path: path of the Unix socket to listen on
+    # num_workers: number of processes processing and analysing images, one per CPU if None
+    # payload_cache_bytes: max total size of the cached processed images
+    # results_cache_size: max number of cached analysis results
+    def __init__(self, socket_path=cfg.SERVICE_SOCKET_PATH, num_workers=cfg.SERVICE_NUM_WORKERS,
+                 payload_cache_bytes=cfg.SERVICE_PAYLOAD_CACHE_BYTES, results_cache_size=cfg.SERVICE_RESULTS_CACHE_SIZE):
+        self.socket_path = socket_path
+        self.num_workers = num_workers
+        self.payload_cache_bytes = payload_cache_bytes
+        self.results_cache_size = results_cache_size
+        self.payloads = OrderedDict() # file key (see _file_key) -> processed image, least recently used first
+        self.payloads_nbytes = 0
+        self.results = OrderedDict() # (body file key, veins file key, mode) -> result, least recently used first
+        self.inflight = {} # key of a payload or result being computed -> its task
+        self.batch_queue = [] # (body processed image, veins processed image, codec, future) waiting to be analysed
+        self.batch_timer = None
+        self.executor = None
+        self.executor_futures = set() # futures of the calls submitted to the worker processes and not done yet
+        self.stats = {"requests": 0, "result_hits": 0, "payload_hits": 0, "coalesced": 0, "encodes": 0, "batches": 0,
+                      "batched_parasites": 0}
+
+    # Run the service until it's interrupted (Ctrl-C or SIGTERM)
+    def run(self):
+        try:
+            asyncio.run(self.serve())
+        except (KeyboardInterrupt, asyncio.CancelledError):
+            pass
+
+    # Listen on the Unix socket and serve the clients
+    async def serve(self):
+        if os.path.exists(self.socket_path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.socket_path)
+            except OSError: # nobody is listening, left over by a service that didn't exit cleanly
+                os.remove(self.socket_path)
+            else:
+                raise RuntimeError(f"An analysis service is already listening on {self.socket_path}")
+            finally:
+                probe.close()
+        self.executor = ProcessPoolExecutor(self.num_workers)
+        server = await asyncio.start_unix_server(self._handle_client, path=self.socket_path)
+        try:
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+            await server.serve_forever()
+        finally:
+            server.close() # not waiting for the open connections, the clients see them closed
+            for future in list(self.executor_futures): # the calls not started yet are dropped, the running ones finish
+                future.cancel()
+            self.executor.shutdown(wait=False)
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+
+    # Run a function in a worker process, keeping track of its future so that it's cancelled if the service stops first
+    # Parameters:
+    # func, args: the function and its arguments, which must be picklable
+    # Returns an asyncio future of the function's result
+    def _run_in_executor(self, func, *args):
+        future = self.executor.submit(func, *args)
+        self.executor_futures.add(future)
+        future.add_done_callback(self.executor_futures.discard)
+        return asyncio.wrap_future(future)
+
+    # Serve a client connection: every request line is handled in its own task, so a client can have several
+    # requests in flight
+    # Parameters:
+    # reader, writer: the asyncio streams of the connection
+    async def _handle_client(self, reader, writer):
+        tasks = set()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                task = asyncio.create_task(self._respond(line, writer))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            await asyncio.gather(*tasks)
+        finally:
+            writer.close()
+
+    # Handle a request line and write the response line
+    async def _respond(self, line, writer):
+        request_id = None
+        try:
+            request = json.loads(line)
+            request_id = request.get("id")
+            response = await self._dispatch(request)
+        except Exception as e:
+            response = {"error": f"{type(e).__name__}: {e}"}
+        response["id"] = request_id
+        writer.write(json.dumps(response).encode() + b"\n")
+        try:
+            await writer.drain()
+        except ConnectionError: # the client went away
+            pass
+
+    # Run a request
+    async def _dispatch(self, request):
+        op = request.get("op", "analyse")
+        if op == "stats":
+            return dict(self.stats, cached_payloads=len(self.payloads), cached_payloads_nbytes=self.payloads_nbytes,
+                        cached_results=len(self.results))
+        if op == "analyse":
+            return dict(await self.analyse(request["body_img_path"], request["veins_img_path"],
+                                           request.get("codec", ScanLinesMicroImage.name), request.get("mode", "exact"),
+                                           request.get("veins_codec")))
+        raise ValueError(f"Unknown op: {op}")
+
+    # Analyse a parasite
+    # Parameters:
+    # body_img_path, veins_img_path: paths to the body and veins image files
+    # codec, veins_codec: names of the MicroImage processing techniques of the body and veins (see Parasite)
+    # mode: see Parasite
+    # Returns a dict of the veins-to-body fraction, its confidence interval in "approx" mode, and the cancer flag
+    async def analyse(self, body_img_path, veins_img_path, codec, mode="exact", veins_codec=None):
+        self.stats["requests"] += 1
+        veins_codec = veins_codec or codec
+        for name in (codec, veins_codec):
+            if name not in CODECS:
+                raise ValueError(f"Unknown codec: {name}")
+        Parasite.check_codecs(CODECS[codec], CODECS[veins_codec]) # before reading or processing any image
+        body_key, veins_key = self._file_key(body_img_path, codec), self._file_key(veins_img_path, veins_codec)
+        key = (body_key, veins_key, mode)
+        if key in self.results:
+            self.stats["result_hits"] += 1
+            self.results.move_to_end(key)
+            return self.results[key]
+        return await self._coalesce(("result",) + key, lambda: self._compute_result(body_key, veins_key, mode))
+
+    # Identify the content of an image file processed with a codec, from its path, modification time and size, so
+    # that the cached payloads and results of a file that changed are not used anymore
+    @staticmethod
+    def _file_key(path, codec):
+        stat = os.stat(path)
+        return (os.path.abspath(path), stat.st_mtime_ns, stat.st_size, codec)
+
+    # Run a computation, unless the same one is already running, in which case wait for its result instead
+    # Parameters:
+    # key: key identifying the computation
+    # make_coro: function returning the coroutine of the computation
+    async def _coalesce(self, key, make_coro):
+        task = self.inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(make_coro())
+            self.inflight[key] = task
+            task.add_done_callback(lambda done: self.inflight.pop(key, None))
+        else:
+            self.stats["coalesced"] += 1
+        return await asyncio.shield(task) # a client going away doesn't cancel the computation for the others
+
+    # Get the processed images and analyse them
+    async def _compute_result(self, body_key, veins_key, mode):
+        body_processed, veins_processed = await asyncio.gather(self._get_payload(body_key),
+                                                               self._get_payload(veins_key))
+        codec, veins_codec = body_key[-1], veins_key[-1]
+        if mode == "exact" and codec == veins_codec and CODECS[codec] in (ScanLinesMicroImage, BitMapMicroImage):
+            veins_body_frac = await self._analyse_in_batch(body_processed, veins_processed, codec)
+            result = {"veins_body_frac": veins_body_frac, "veins_body_frac_bounds": None,
+                      "has_cancer": veins_body_frac > cfg.CANCER_THRESH_PERC}
+        else:
+            result = await self._run_in_executor(_analyse_one, body_processed, veins_processed, codec, veins_codec,
+                                                 mode)
+        self.results[(body_key, veins_key, mode)] = result
+        while len(self.results) > self.results_cache_size:
+            self.results.popitem(last=False)
+        return result
+
+    # Get the processed image of a file, from the cache or by processing it in a worker process
+    # Parameters:
+    # file_key: see _file_key
+    async def _get_payload(self, file_key):
+        if file_key in self.payloads:
+            self.stats["payload_hits"] += 1
+            self.payloads.move_to_end(file_key)
+            return self.payloads[file_key]
+        return await self._coalesce(("payload",) + file_key, lambda: self._encode(file_key))
+
+    # Process an image file in a worker process and cache the result, evicting the least recently used payloads
+    async def _encode(self, file_key):
+        path, mtime_ns, size, codec = file_key
+        processed = await self._run_in_executor(_encode_image, path, codec)
+        self.stats["encodes"] += 1
+        if processed.nbytes <= self.payload_cache_bytes:
+            self.payloads[file_key] = processed
+            self.payloads_nbytes += processed.nbytes
+            while self.payloads_nbytes > self.payload_cache_bytes:
+                evicted_key, evicted = self.payloads.popitem(last=False)
+                self.payloads_nbytes -= evicted.nbytes
+        return processed
+
+    # Queue an exact analysis to be computed with the others arriving within cfg.SERVICE_BATCH_WINDOW_SECS
+    # Returns the veins-to-body fraction
+    async def _analyse_in_batch(self, body_processed, veins_processed, codec):
+        future = asyncio.get_running_loop().create_future()
+        self.batch_queue.append((body_processed, veins_processed, codec, future))
+        if len(self.batch_queue) >= cfg.SERVICE_MAX_BATCH:
+            self._flush_batch()
+        elif self.batch_timer is None:
+            self.batch_timer = asyncio.get_running_loop().call_later(cfg.SERVICE_BATCH_WINDOW_SECS, self._flush_batch)
+        return await future
+
+    # Start the analysis of the queued parasites, one batch per codec
+    def _flush_batch(self):
+        if self.batch_timer is not None:
+            self.batch_timer.cancel()
+            self.batch_timer = None
+        queued, self.batch_queue = self.batch_queue, []
+        for codec in set(item[2] for item in queued):
+            asyncio.ensure_future(self._run_batch([item for item in queued if item[2] == codec], codec))
+
+    # Analyse a batch of parasites with ParasiteBatch in a worker process, and hand every parasite its result. If the batch
+    # fails (e.g. one parasite's body and veins sizes differ), its parasites are analysed one by one
+    # Parameters:
+    # items: queued (body processed image, veins processed image, codec, future)
+    # codec: name of the MicroImage processing technique of all the items
+    async def _run_batch(self, items, codec):
+        try:
+            veins_body_fracs = await self._run_in_executor(
+                _calc_batch, [(body, veins) for body, veins, item_codec, future in items], codec)
+        except Exception as e:
+            if len(items) > 1:
+                await asyncio.gather(*[self._run_batch([item], codec) for item in items])
+            elif not items[0][3].done():
+                items[0][3].set_exception(e)
+            return
+        self.stats["batches"] += 1
+        self.stats["batched_parasites"] += len(items)
+        for (body, veins, item_codec, future), veins_body_frac in zip(items, veins_body_fracs):
+            if not future.done():
+                future.set_result(float(veins_body_frac))
+
+if __name__=="__main__":
+
+    # Serve the lab tools until interrupted, see AnalysisClient
+    AnalysisService().run()
@@ -0,0 +1,203 @@
+import config as cfg
+import bz2
+from concurrent.futures import ThreadPoolExecutor
+import lzma
+import numpy as np
+import struct
+import zlib
+
+
+'''
+ChunkedCompressor class adds an entropy coding stage over processed images: the processed image is cut into chunks of
+a fixed number of elements, every chunk goes through optional filters (delta, byte shuffle) and is compressed on its
+own with zlib, bz2 or lzma. Any chunk can be decompressed without the others, for random access (e.g. reading just
+the header of a processed image) or to decompress all the chunks in parallel.
+Layout: container header (see container_header), chunk table (offset and compressed size of every chunk, <u8 each),
+then the compressed chunks.
+'''
+class ChunkedCompressor():
+
+    # Container header: magic bytes, format version, codec id, filters bitmask, NumPy type code of the processed image
+    # elements, number of elements, number of elements per chunk and number of chunks
+    container_header = struct.Struct("<4sBBBcQQQ")
+    # id: (name, compress function, decompress function, default level)
+    CODECS = {0: ("none", lambda data, level: bytes(data), bytes, None),
+              1: ("zlib", lambda data, level: zlib.compress(data, level), zlib.decompress, 6),
+              2: ("bz2", lambda data, level: bz2.compress(data, level), bz2.decompress, 9),
+              3: ("lzma", lambda data, level: lzma.compress(data, preset=level), lzma.decompress, 6)}
+    # Filters, always applied in this order before compressing: "delta" stores the difference of every element with
+    # the previous one (wrapping around), "shuffle" groups the n-th bytes of all the elements together
+    FILTERS = {"delta": 1, "shuffle": 2}
+    TYPE_CODES = {np.dtype(np.uint8): b"B", np.dtype(np.uint16): b"H"}
+
+    # Initialize ChunkedCompressor object
+    # Parameters:
+    # codec: "zlib", "bz2", "lzma" or "none"
+    # level: compression level of the codec, its default if None
+    # filters: filters to apply to every chunk before compressing it, among "delta" and "shuffle". Shuffling the bytes
+    #          of uint16 run lengths puts their mostly zero high bytes together; it is a no-op for uint8 images
+    # chunk_nbytes: uncompressed size of every chunk but the last
+    def __init__(self, codec="zlib", level=None, filters=("shuffle",), chunk_nbytes=cfg.ENTROPY_CHUNK_BYTES):
+        codec_ids = {name: codec_id for codec_id, (name, compress, decompress, default_level) in self.CODECS.items()}
+        if codec not in codec_ids:
+            raise ValueError(f"Unknown codec: {codec}")
+        unknown_filters = set(filters) - set(self.FILTERS)
+        if unknown_filters:
+            raise ValueError(f"Unknown filters: {', '.join(sorted(unknown_filters))}")
+        self.codec_id = codec_ids[codec]
+        self.level = self.CODECS[self.codec_id][3] if level is None else level
+        self.filter_mask = sum(self.FILTERS[name] for name in set(filters))
+        self.chunk_nbytes = chunk_nbytes
+
+    # Compress a processed image
+    # Parameters:
+    # processed: the processed image, a 1-D uint8 or uint16 array
+    # Returns the compressed bytes
+    def compress(self, processed):
+        processed = np.asarray(processed)
+        if processed.ndim != 1 or processed.dtype not in self.TYPE_CODES:
+            raise ValueError("Only 1-D uint8 or uint16 processed images can be compressed")
+        processed = processed.astype(processed.dtype.newbyteorder("<"), copy=False)
+        chunk_elements = max(1, self.chunk_nbytes // processed.itemsize)
+        compress = self.CODECS[self.codec_id][1]
+        chunks = [compress(self._filter(processed[i:i + chunk_elements], self.filter_mask), self.level)
+                  for i in range(0, processed.size, chunk_elements)]
+        header = self.container_header.pack(cfg.ENTROPY_MAGIC, cfg.ENTROPY_VERSION, self.codec_id, self.filter_mask,
+                                            self.TYPE_CODES[processed.dtype], processed.size, chunk_elements,
+                                            len(chunks))
+        nbytes = np.array([len(chunk) for chunk in chunks], dtype="<u8")
+        data_start = len(header) + 16 * len(chunks)
+        table = np.stack((data_start + np.cumsum(nbytes) - nbytes, nbytes), axis=1).astype("<u8")
+        return b"".join([header, table.tobytes()] + chunks)
+
+    # Compress a processed image to a file
+    # Parameters:
+    # path: path of the file to create
+    # processed: see compress
+    # Returns the compression ratio of every chunk, see chunk_ratios
+    def save(self, path, processed):
+        compressed = self.compress(processed)
+        with open(path, "wb") as outfile:
+            outfile.write(compressed)
+        return self.chunk_ratios(compressed)
+
+    # Map a compressed file in memory, so that only the chunks that are decompressed get read from disk
+    # Parameters:
+    # path: path of the compressed file
+    @staticmethod
+    def open_file(path):
+        return np.memmap(path, mode="r", dtype=np.uint8)
+
+    # Apply the filters of filter_mask to a chunk
+    @classmethod
+    def _filter(cls, chunk, filter_mask):
+        if filter_mask & cls.FILTERS["delta"]:
+            chunk = np.diff(chunk, prepend=chunk.dtype.type(0)) # wraps around
+        if filter_mask & cls.FILTERS["shuffle"]:
+            chunk = chunk.view(np.uint8).reshape(-1, chunk.itemsize).T
+        return np.ascontiguousarray(chunk).data
+
+    # Undo the filters of filter_mask on a decompressed chunk
+    @classmethod
+    def _unfilter(cls, data, filter_mask, dtype):
+        chunk = np.frombuffer(data, dtype=np.uint8)
+        if filter_mask & cls.FILTERS["shuffle"]:
+            chunk = chunk.reshape(dtype.itemsize, -1).T
+        chunk = np.ascontiguousarray(chunk).view(dtype).reshape(-1)
+        if filter_mask & cls.FILTERS["delta"]:
+            chunk = np.cumsum(chunk, dtype=dtype) # wraps around
+        return chunk
+
+    # Parse the container header and chunk table of a compressed processed image
+    # Parameters:
+    # buffer: the compressed bytes, or the result of open_file
+    # Returns a dict of the container header fields, and the chunk table as an array of (offset, compressed size)
+    @classmethod
+    def _ret_layout(cls, buffer):
+        buffer = memoryview(buffer).cast("B")
+        magic, version, codec_id, filter_mask, type_code, num_elements, chunk_elements, num_chunks = \
+            cls.container_header.unpack(buffer[:cls.container_header.size])
+        if magic != cfg.ENTROPY_MAGIC:
+            raise ValueError("Not a compressed processed image")
+        if version != cfg.ENTROPY_VERSION or codec_id not in cls.CODECS:
+            raise ValueError(f"Unsupported compressed processed image (version {version}, codec {codec_id})")
+        layout = {"codec_id": codec_id, "filter_mask": filter_mask,
+                  "dtype": np.dtype(type_code.decode()).newbyteorder("<"), "num_elements": num_elements,
+                  "chunk_elements": chunk_elements, "num_chunks": num_chunks}
+        table_end = cls.container_header.size + 16 * num_chunks
+        table = np.frombuffer(buffer[cls.container_header.size:table_end], dtype="<u8").reshape(num_chunks, 2)
+        return layout, table.astype(np.int64)
+
+    # Read the container header of a compressed processed image, without decompressing anything
+    # Parameters:
+    # buffer: see _ret_layout
+    # Returns a dict of the codec name, filter names, dtype and number of elements of the processed image, and the
+    # number of elements per chunk and number of chunks
+    @classmethod
+    def read_layout(cls, buffer):
+        layout, table = cls._ret_layout(buffer)
+        return {"codec": cls.CODECS[layout["codec_id"]][0],
+                "filters": [name for name, bit in cls.FILTERS.items() if layout["filter_mask"] & bit],
+                "dtype": layout["dtype"], "num_elements": layout["num_elements"],
+                "chunk_elements": layout["chunk_elements"], "num_chunks": layout["num_chunks"]}
+
+    # Decompress a single chunk
+    # Parameters:
+    # buffer: see _ret_layout
+    # chunk_idx: index of the chunk
+    # Returns the elements of the processed image in the chunk
+    @classmethod
+    def decompress_chunk(cls, buffer, chunk_idx):
+        layout, table = cls._ret_layout(buffer)
+        return cls._decompress_chunk(buffer, layout, table, chunk_idx)
+
+    # Decompress a single chunk, with the container header and chunk table already parsed (see _ret_layout)
+    @classmethod
+    def _decompress_chunk(cls, buffer, layout, table, chunk_idx):
+        offset, nbytes = table[chunk_idx]
+        data = cls.CODECS[layout["codec_id"]][2](memoryview(buffer).cast("B")[offset:offset + nbytes])
+        return cls._unfilter(data, layout["filter_mask"], layout["dtype"])
+
+    # Decompress the elements start:stop of a processed image, only decompressing the chunks they're in
+    # Parameters:
+    # buffer: see _ret_layout
+    # start, stop: range of elements
+    @classmethod
+    def decompress_range(cls, buffer, start, stop):
+        layout, table = cls._ret_layout(buffer)
+        stop = min(stop, layout["num_elements"])
+        chunk_elements = layout["chunk_elements"]
+        chunks = [cls._decompress_chunk(buffer, layout, table, chunk_idx)
+                  for chunk_idx in range(start // chunk_elements, -(-stop // chunk_elements))]
+        first = (start // chunk_elements) * chunk_elements
+        return np.concatenate([np.zeros(0, dtype=layout["dtype"])] + chunks)[start - first:stop - first]
+
+    # Decompress a whole processed image, chunks in parallel
+    # Parameters:
+    # buffer: see _ret_layout
+    # max_workers: number of threads decompressing chunks (the codecs release the GIL), one per CPU by default
+    @classmethod
+    def decompress(cls, buffer, max_workers=None):
+        layout, table = cls._ret_layout(buffer)
+        res = np.empty(layout["num_elements"], dtype=layout["dtype"])
+        chunk_elements = layout["chunk_elements"]
+
+        def decompress_into(chunk_idx):
+            res[chunk_idx * chunk_elements:(chunk_idx + 1) * chunk_elements] = \
+                cls._decompress_chunk(buffer, layout, table, chunk_idx)
+
+        with ThreadPoolExecutor(max_workers) as executor:
+            list(executor.map(decompress_into, range(layout["num_chunks"])))
+        return res
+
+    # Compression ratio (uncompressed size / compressed size) of every chunk
+    # Parameters:
+    # buffer: see _ret_layout
+    @classmethod
+    def chunk_ratios(cls, buffer):
+        layout, table = cls._ret_layout(buffer)
+        chunk_nbytes = np.full(layout["num_chunks"], layout["chunk_elements"] * layout["dtype"].itemsize)
+        if layout["num_chunks"]:
+            chunk_nbytes[-1] = (layout["num_elements"] - layout["chunk_elements"] * (layout["num_chunks"] - 1)) * \
+                layout["dtype"].itemsize
+        return chunk_nbytes / np.maximum(table[:, 1], 1)
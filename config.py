@@ -7,6 +7,9 @@ DATA_DIR = "data"
 PROCESSED_DIR = os.path.join(DATA_DIR, "processed")
 COLLECTED_DIR = os.path.join(DATA_DIR, "collected")
 SPECIAL_COLLECTED_DIR = os.path.join(DATA_DIR, "special_collected")
+RESULTS_INDEX_PATH = os.path.join(DATA_DIR, "results_index.sqlite")
+WORK_QUEUE_PATH = os.path.join(DATA_DIR, "work_queue.sqlite")
+SERVICE_SOCKET_PATH = os.path.join(DATA_DIR, "analysis_service.sock")
 
 '''
 Data Information
@@ -32,5 +35,56 @@ Image Processing metadata
 '''
 SCANLINES_CHECKBYTES = 179 # make sure to fit in uint8
 BITMAP_CHECKBYTES = 239
+VDELTA_CHECKBYTES = 199
+SPARSE_CHECKBYTES = 211
 SCANLINES_DTYPE = "uint16"
-BITMAP_DTYPE = "uint8"
\ No newline at end of file
+BITMAP_DTYPE = "uint8"
+VDELTA_DTYPE = "uint8"
+VDELTA_BAND_ROWS = 1024 # number of rows read at once by the vertical delta processing
+SPARSE_DTYPE = "uint8"
+SPARSE_BAND_ROWS = 1024 # number of rows read at once by the sparse processing
+HEADER_BAND_ROWS = 1024 # number of rows read at once when computing the header stats
+DECODE_CHUNK_ROWS = 1024 # number of rows unpacked at once when decoding a bitmap into a buffer
+TIFF_ROWS_PER_STRIP = 256 # number of rows decoded and written at once when exporting a processed image to TIFF
+
+'''
+Analysis configuration
+'''
+EARLY_EXIT_CHUNK_RUNS = 1024 # number of scanlines body runs to overlap before checking for an early exit
+EARLY_EXIT_VEIN_CHUNK_RUNS = 16384 # number of veins runs decoded at once while overlapping them with the body runs
+EARLY_EXIT_CHUNK_BYTES = 65536 # number of bitmap bytes to overlap before checking for an early exit
+APPROX_NUM_SAMPLES = 2000 # number of body pixels sampled by the approximate analysis
+APPROX_Z_SCORE = 3.29 # z score of the approximate analysis confidence interval (99.9%)
+APPROX_MAX_DRAWS = 32 # max number of rounds of random pixel draws when sampling body pixels by rejection
+RESULTS_INDEX_HASH_CHUNK = 1 << 20 # number of bytes read at once when hashing input images for the results index
+
+'''
+Work queue configuration
+'''
+WORK_QUEUE_LEASE_SECS = 60 # how long a claimed job stays reserved to its worker without a heartbeat
+WORK_QUEUE_HEARTBEAT_SECS = 15 # how often a worker renews the lease of the job it's running
+WORK_QUEUE_MAX_ATTEMPTS = 3 # number of times a job is claimed before it's given up on
+WORK_QUEUE_POLL_SECS = 1 # how long an idle worker waits before looking for a job again
+WORK_QUEUE_DB_TIMEOUT_SECS = 30 # how long to wait for another process holding the queue database lock
+
+'''
+Transport configuration
+'''
+TRANSPORT_MAGIC = b"PRSM" # first bytes of every frame of a processed image sent with transport.py
+TRANSPORT_VERSION = 1
+
+'''
+Compression configuration
+'''
+ENTROPY_MAGIC = b"PRSC" # first bytes of every processed image compressed with chunked_codec.py
+ENTROPY_VERSION = 1
+ENTROPY_CHUNK_BYTES = 1 << 20 # uncompressed size of the independently decompressible chunks
+
+'''
+Analysis service configuration
+'''
+SERVICE_PAYLOAD_CACHE_BYTES = 1 << 30 # max total size of the processed images kept in memory by the analysis service
+SERVICE_RESULTS_CACHE_SIZE = 100000 # max number of analysis results kept in memory by the analysis service
+SERVICE_BATCH_WINDOW_SECS = 0.002 # how long the analysis service waits for more requests to analyse them together
+SERVICE_MAX_BATCH = 256 # max number of parasites analysed together by the analysis service
+SERVICE_NUM_WORKERS = None # number of processes encoding and analysing images for the analysis service, one per CPU if None
\ No newline at end of file
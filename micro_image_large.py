@@ -1,11 +1,12 @@
 import config as cfg
 import base64
+from chunked_codec import ChunkedCompressor
 from io import BytesIO  
-import matplotlib.pyplot as plt
 import numpy as np
 import os
-from PIL import Image, ImageChops
-from sys import getsizeof
+from tiff_writer import StripedTiffWriter
+# Pillow (image files) and matplotlib (show_* methods) are imported on first use, so that processes only handling
+# processed images only pay for NumPy
 
 
 '''
@@ -13,6 +14,13 @@ MicroImageLarge class handles the loading, processing, and process validation of
 '''
 class MicroImageLarge():
 
+    # Layout of the binary header packed right after the check byte of every processed image: image size, number of
+    # positive pixels, tight bounding box of the positive pixels (end row and end col excluded) and number of processed
+    # elements after the header
+    header_dtype = np.dtype([("rows", "<u4"), ("cols", "<u4"), ("num_pos_pix", "<u8"),
+                             ("row_start", "<u4"), ("col_start", "<u4"), ("row_end", "<u4"), ("col_end", "<u4"),
+                             ("num_elements", "<u8")])
+
     # Initialize MicroImageLarge object
     # Parameters:
     # Path: the path to the image file to be processed
@@ -21,16 +29,33 @@ class MicroImageLarge():
         self.raw = self._read_img(path)
         self.processed = self._process()
 
+    # Create a MicroImage object straight from a processed image (e.g. received with transport.py or loaded from a saved
+    # file), without the raw image. Only the methods that work from the processed image can then be used, not e.g.
+    # validate_process, or ScanLinesMicroImage.calc_veins_perc which reads the raw veins image
+    # Parameters:
+    # processed: the processed image, made with this MicroImage processing technique
+    @classmethod
+    def from_processed(cls, processed):
+        if int(processed[0]) != cls.check_byte:
+            raise ValueError(f"Processed image was not made with {cls.__name__}")
+        micro_image = cls.__new__(cls)
+        micro_image.raw_size = None
+        micro_image.raw = None
+        micro_image.processed = processed
+        return micro_image
+
     # Reads image file, currently uses Pillow
     # Parameters:
     # Path: the path to the image file to be processed
     def _read_img(self, path):
+        from PIL import Image
         return Image.open(path)
 
     # Helper function to convert a binary numpy (1 for positive pixel, 0 for background) to a 0 255 Pillow image
     # Parameters:
     # bin_npy: binary numpy (1 for positive pixel, 0 for background)
     def _bin_npy_to_raw(self, bin_npy):
+        from PIL import Image
         return Image.fromarray((1-bin_npy.astype(np.uint8))*255)
 
     # Create an 8-bit friendly representation of an image size 
@@ -53,9 +78,78 @@ class MicroImageLarge():
     # Parameters:
     # processed: the processed image
     def _ret_header(self, processed):
-        check_byte = processed[0]
-        data_start_idx, num_rows, num_cols = self._ret_shape_from_repr(processed[1:])
-        return check_byte, data_start_idx + 1, num_rows, num_cols
+        header = self._ret_header_fields(processed)
+        return header["check_byte"], header["data_start_idx"], header["rows"], header["cols"]
+
+    # Pack the check byte and the binary header (see header_dtype) as elements of the processed dtype
+    # Parameters:
+    # rows, cols: number of rows and columns of the image
+    # stats: dict of the number of positive pixels and bounding box, see _ret_raw_stats
+    # num_elements: number of processed elements that will follow the header
+    def _make_header(self, rows, cols, stats, num_elements):
+        header = np.zeros(1, dtype=self.header_dtype)
+        header["rows"], header["cols"], header["num_elements"] = rows, cols, num_elements
+        for field in ("num_pos_pix", "row_start", "col_start", "row_end", "col_end"):
+            header[field] = stats[field]
+        header_elements = np.frombuffer(header.tobytes(), dtype=np.dtype(self.dtype).newbyteorder("<"))
+        return np.concatenate(([self.check_byte], header_elements)).astype(self.dtype)
+
+    # Unpack the header of a processed image into a dict of the header_dtype fields, plus the check byte and the index
+    # at which the processed data starts. Only the first few elements are read, and only the dtype of the processed
+    # image is needed, so it works on any processed image, e.g. memory-mapped from a saved file.
+    # The number of processed elements in the header must match the size of the processed image, so that an image
+    # without this header (e.g. saved with the older decimal size header) is rejected instead of read as garbage
+    # Parameters:
+    # processed: the processed image, or only its first elements if size is given
+    # size: total number of elements of the processed image, processed.size by default
+    @staticmethod
+    def _ret_header_fields(processed, size=None):
+        header_len = MicroImageLarge.header_dtype.itemsize // processed.itemsize
+        size = processed.size if size is None else size
+        if processed.size < 1 + header_len:
+            raise ValueError("Processed image is too short to hold a header")
+        header_bytes = np.asarray(processed[1:1 + header_len]).astype(processed.dtype.newbyteorder("<")).tobytes()
+        header = np.frombuffer(header_bytes, dtype=MicroImageLarge.header_dtype)[0]
+        fields = {name: int(header[name]) for name in MicroImageLarge.header_dtype.names}
+        fields["check_byte"] = int(processed[0])
+        fields["data_start_idx"] = 1 + header_len
+        if fields["num_elements"] != size - fields["data_start_idx"]:
+            raise ValueError(f"Processed image header holds {fields['num_elements']} elements instead of "
+                             f"{size - fields['data_start_idx']}, it was not made with this header format")
+        return fields
+
+    # Read the header of a processed image saved with save_processed_img without reading the rest of the file
+    # Parameters:
+    # path: path to the saved .npy processed image
+    @staticmethod
+    def read_saved_header(path):
+        return MicroImageLarge._ret_header_fields(np.load(path, mmap_mode="r"))
+
+    # Read the header of this processed image
+    # Returns a dict of the header_dtype fields, plus the check byte and the index at which the processed data starts
+    def read_header(self):
+        return self._ret_header_fields(self.processed)
+
+    # Compute the number of positive pixels and their tight bounding box from the raw image, reading it in bands of
+    # cfg.HEADER_BAND_ROWS rows
+    def _ret_raw_stats(self):
+        cols, rows = self.raw.size
+        stats = {"num_pos_pix": 0, "row_start": 0, "col_start": 0, "row_end": 0, "col_end": 0}
+        pos_cols = np.zeros(cols, dtype=bool)
+        for band_start in range(0, rows, cfg.HEADER_BAND_ROWS):
+            band_end = min(band_start + cfg.HEADER_BAND_ROWS, rows)
+            bin_band = np.asarray(self.raw.crop((0, band_start, cols, band_end))) != 255
+            pos_rows = np.flatnonzero(bin_band.any(axis=1))
+            if pos_rows.size:
+                if stats["num_pos_pix"] == 0:
+                    stats["row_start"] = band_start + int(pos_rows[0])
+                stats["row_end"] = band_start + int(pos_rows[-1]) + 1
+                stats["num_pos_pix"] += int(bin_band.sum())
+                pos_cols |= bin_band.any(axis=0)
+        if stats["num_pos_pix"]:
+            stats["col_start"] = int(np.argmax(pos_cols))
+            stats["col_end"] = cols - int(np.argmax(pos_cols[::-1]))
+        return stats
     
     # Processing routine to compress parasite images to smaller numpy arrays
     def _process(self):
@@ -67,17 +161,117 @@ class MicroImageLarge():
     def _inverse_process(self, processed_img):
         raise NotImplementedError
 
+    # Decode the processed image straight into a caller-provided buffer (e.g. reused across many images, or an
+    # np.memmap), instead of allocating new arrays and a Pillow image like _inverse_process
+    # Parameters:
+    # out: C-contiguous array of shape (row_stop - row_start, cols) and dtype bool or uint8 that will hold 1 for positive
+    #      pixels and 0 for background, or with packed=True, uint8 array of shape (row_stop - row_start, ceil(cols / 8))
+    #      holding 8 pixels per byte (most significant bit first, every row starting on a new byte)
+    # row_start, row_stop: range of rows to decode, defaults to the whole image
+    # packed: whether out is bit-packed
+    # Returns out
+    def decode_into(self, out, row_start=0, row_stop=None, packed=False):
+        header = self._ret_header_fields(self.processed)
+        row_stop = self._check_row_range(header, row_start, row_stop)
+        expected_shape = (row_stop - row_start, -(-header["cols"] // 8) if packed else header["cols"])
+        if out.shape != expected_shape or not out.flags.c_contiguous:
+            raise ValueError(f"Decoding buffer must be a C-contiguous array of shape {expected_shape}")
+        if out.dtype != np.uint8 and (packed or out.dtype != bool):
+            raise ValueError("Decoding buffer must be of dtype uint8" + ("" if packed else " or bool"))
+        out.fill(0)
+        self._decode_rows_into(out, row_start, row_stop, packed)
+        return out
+
+    # Decode the processed image into a new .npy file through a memory map, so that the decoded image never has to
+    # fit in memory
+    # Parameters:
+    # path: path of the .npy file to create
+    # row_start, row_stop, packed: see decode_into
+    # Returns the np.memmap
+    def decode_to_memmap(self, path, row_start=0, row_stop=None, packed=False):
+        header = self._ret_header_fields(self.processed)
+        row_stop = self._check_row_range(header, row_start, row_stop) # before the file gets created
+        shape = (row_stop - row_start, -(-header["cols"] // 8) if packed else header["cols"])
+        out = np.lib.format.open_memmap(path, mode="w+", dtype=np.uint8, shape=shape)
+        self.decode_into(out, row_start, row_stop, packed)
+        out.flush()
+        return out
+
+    # Check a range of rows to decode
+    # Parameters:
+    # header: result of _ret_header_fields
+    # row_start, row_stop: see decode_into
+    # Returns row_stop, the number of rows of the image if None
+    @staticmethod
+    def _check_row_range(header, row_start, row_stop):
+        row_stop = header["rows"] if row_stop is None else row_stop
+        if not 0 <= row_start <= row_stop <= header["rows"]:
+            raise ValueError(f"Invalid row range {row_start}:{row_stop} for an image of {header['rows']} rows")
+        return row_stop
+
+    # Export the processed image to an uncompressed TIFF file, decoding it one strip of rows at a time straight into
+    # the TIFF writer, so that only one strip of the image is ever in memory
+    # Parameters:
+    # path: path of the TIFF file to create
+    # bilevel: write 1 bit per pixel (positive pixels black). Pillow opens such files in mode "1", so they can't be
+    #          processed again as is, unlike the 8-bit 0 (positive) / 255 (background) files written otherwise
+    # rows_per_strip: number of rows per strip of the TIFF file
+    def export_tiff(self, path, bilevel=True, rows_per_strip=cfg.TIFF_ROWS_PER_STRIP):
+        header = self._ret_header_fields(self.processed)
+        rows, cols = header["rows"], header["cols"]
+        photometric = StripedTiffWriter.WHITE_IS_ZERO if bilevel else StripedTiffWriter.BLACK_IS_ZERO
+        with StripedTiffWriter(path, rows, cols, 1 if bilevel else 8, rows_per_strip, photometric) as writer:
+            strip_buffer = np.empty((writer.rows_per_strip, writer.row_nbytes), dtype=np.uint8)
+            for row_start in range(0, rows, writer.rows_per_strip):
+                row_stop = min(row_start + writer.rows_per_strip, rows)
+                strip = self.decode_into(strip_buffer[:row_stop - row_start], row_start, row_stop, packed=bilevel)
+                if not bilevel: # 1 positive, 0 background => 0 positive, 255 background
+                    np.subtract(1, strip, out=strip)
+                    strip *= 255
+                writer.write_strip(strip)
+
+    # Write the decoded rows row_start:row_stop into the zeroed buffer out (see decode_into)
+    def _decode_rows_into(self, out, row_start, row_stop, packed):
+        raise NotImplementedError
+
+    # Helper function to set the pixels of row segments in a decoding buffer
+    # Parameters:
+    # out: the buffer (see decode_into)
+    # rows, col_starts, col_ends: row (within out) and range of columns of every segment
+    # packed: whether out is bit-packed
+    # The segments are expected in raster order, and are drawn cfg.DECODE_CHUNK_ROWS rows at a time: +1 at the first
+    # pixel and -1 past the last pixel of every segment, then a running sum over the rows of the chunk
+    def _fill_segments(self, out, rows, col_starts, col_ends, packed):
+        width = out.shape[1] * 8 if packed else out.shape[1]
+        for chunk_start in range(0, out.shape[0], cfg.DECODE_CHUNK_ROWS):
+            chunk_stop = min(chunk_start + cfg.DECODE_CHUNK_ROWS, out.shape[0])
+            first, last = np.searchsorted(rows, [chunk_start, chunk_stop])
+            if first == last:
+                continue
+            chunk_rows = rows[first:last] - chunk_start
+            edges = np.zeros((chunk_stop - chunk_start) * width + 1, dtype=np.int8)
+            np.add.at(edges, chunk_rows * width + col_starts[first:last], 1)
+            np.add.at(edges, chunk_rows * width + col_ends[first:last], -1)
+            chunk_pix = np.cumsum(edges[:-1], dtype=np.int8).reshape(chunk_stop - chunk_start, width)
+            if packed:
+                out[chunk_start:chunk_stop] |= np.packbits(chunk_pix.view(bool), axis=1)
+            else:
+                out[chunk_start:chunk_stop] |= chunk_pix.view(out.dtype)
+
     # Performs a validation sequence that checks for differences between the raw Pillow
     def validate_process(self):
+        from PIL import ImageChops
         return (ImageChops.difference(self.raw, self._inverse_process(self.processed)).getbbox()) is None
 
     # Shows the raw image
     def show_raw_img(self):
+        import matplotlib.pyplot as plt
         plt.imshow(self.raw, cmap='gray')
         plt.show()
 
     # Shows the inversed(processed(raw)) image
     def show_inversed_img(self):
+        import matplotlib.pyplot as plt
         plt.imshow(self._inverse_process(self.processed), cmap='gray')
         plt.show()
 
@@ -87,6 +281,33 @@ class MicroImageLarge():
     def save_processed_img(self, filename):
         raise NotImplementedError
 
+    # Save the processed image compressed in independently decompressible chunks (see ChunkedCompressor)
+    # Parameters:
+    # filename: the filename with which to save the processed image
+    # compressor: the ChunkedCompressor to use, zlib with byte shuffling by default
+    # Returns the compression ratio of every chunk
+    def save_compressed_img(self, filename, compressor=None):
+        path = os.path.join(cfg.PROCESSED_DIR, f"{filename}.pcz")
+        return (compressor or ChunkedCompressor()).save(path, self.processed)
+
+    # Load a processed image saved with save_compressed_img, decompressing its chunks in parallel
+    # Parameters:
+    # path: path to the saved .pcz processed image
+    @staticmethod
+    def load_compressed_img(path):
+        return ChunkedCompressor.decompress(ChunkedCompressor.open_file(path))
+
+    # Read the header of a processed image saved with save_compressed_img, only decompressing the first chunk
+    # Parameters:
+    # path: path to the saved .pcz processed image
+    @staticmethod
+    def read_compressed_header(path):
+        buffer = ChunkedCompressor.open_file(path)
+        layout = ChunkedCompressor.read_layout(buffer)
+        header_len = 1 + MicroImageLarge.header_dtype.itemsize // layout["dtype"].itemsize
+        return MicroImageLarge._ret_header_fields(ChunkedCompressor.decompress_range(buffer, 0, header_len),
+                                                  layout["num_elements"])
+
     # print the memory usage of the raw and processed images, as well as the compression rate
     def print_memory(self):
         raise NotImplementedError
@@ -95,14 +316,453 @@ class MicroImageLarge():
     def calc_veins_perc(self, veins_of_this_body):
         return NotImplementedError
 
+    # Determine whether the percentage of veins pixels within the body exceeds thresh, without necessarily scanning the
+    # whole image. The overlap is accumulated chunk by chunk, and the scan stops as soon as the vein-in-body pixels
+    # exceed thresh of the body, or the body pixels left can no longer push the fraction over thresh.
+    # Parameters:
+    # veins_of_this_body: the MicroImageLarge veins image of this body
+    # thresh: the veins-to-body fraction above which the parasite has cancer
+    def classify_veins_perc(self, veins_of_this_body, thresh=cfg.CANCER_THRESH_PERC):
+        num_body_pix = self._count_body_pix() # known up front from the processed body
+        thresh_pix = thresh * num_body_pix
+        valid_vein = 0
+        body_pix_left = num_body_pix
+        for chunk_body_pix, chunk_valid_vein in self._iter_overlap_chunks(veins_of_this_body):
+            valid_vein += chunk_valid_vein
+            body_pix_left -= chunk_body_pix
+            if valid_vein > thresh_pix: # already over the threshold
+                return True
+            if valid_vein + body_pix_left <= thresh_pix: # can no longer get over the threshold
+                return False
+        return valid_vein > thresh_pix
+
+    # Estimate the percentage of veins pixels within the body by testing a random sample of body pixels against the
+    # processed veins image. Returns the estimate and the bounds of its Wilson score confidence interval.
+    # Parameters:
+    # veins_of_this_body: the MicroImageLarge veins image of this body
+    # num_samples: number of body pixels to sample (with replacement)
+    # z_score: z score of the confidence level of the interval
+    # seed: seed of the random generator, for reproducible estimates
+    def estimate_veins_perc(self, veins_of_this_body, num_samples=cfg.APPROX_NUM_SAMPLES,
+                            z_score=cfg.APPROX_Z_SCORE, seed=None):
+        body_pix = self._sample_body_pix(num_samples, np.random.default_rng(seed))
+        if body_pix.size == 0:
+            if self._count_body_pix() == 0: # no body pixels to sample from
+                return 0.0, 0.0, 0.0
+            # no body pixel drawn (e.g. a few body pixels in a large bounding box, see BitMapMicroImage): the interval
+            # of an empty sample is uninformative, so that the caller computes the fraction exactly
+            return 0.5, 0.0, 1.0
+        num_samples = body_pix.size
+        estimate = veins_of_this_body._is_positive(body_pix).sum() / num_samples
+        denom = 1 + z_score ** 2 / num_samples
+        center = (estimate + z_score ** 2 / (2 * num_samples)) / denom
+        half_width = z_score * np.sqrt(estimate * (1 - estimate) / num_samples +
+                                       z_score ** 2 / (4 * num_samples ** 2)) / denom
+        return float(estimate), float(max(center - half_width, 0.0)), float(min(center + half_width, 1.0))
+
+    # number of body pixels, read from the header of the processed image
+    def _count_body_pix(self):
+        return self._ret_header_fields(self.processed)["num_pos_pix"]
+
+    # Draw random body pixels (uniformly, with replacement) using only the processed image
+    # Parameters:
+    # num_samples: number of body pixels to draw
+    # rng: numpy random Generator
+    def _sample_body_pix(self, num_samples, rng):
+        raise NotImplementedError
+
+    # Look up whether the given pixel indices are positive pixels using only the processed image
+    # Parameters:
+    # pix: array of pixel indices
+    def _is_positive(self, pix):
+        raise NotImplementedError
+
+    # Generator of (number of body pixels, number of vein-in-body pixels) for successive chunks of the image
+    # Parameters:
+    # veins_of_this_body: the MicroImageLarge veins image of this body
+    def _iter_overlap_chunks(self, veins_of_this_body):
+        raise NotImplementedError
+
+    # helper function to count, for each of the given pixel indices, the positive pixels that come before it
+    # Parameters:
+    # starts, ends: sorted pixel indices of the first and one-past-the-last pixel of each positive run
+    # pix: array of pixel indices
+    @staticmethod
+    def _count_run_pix_before(starts, ends, pix):
+        if starts.size == 0:
+            return np.zeros(np.shape(pix), dtype=np.int64)
+        run_pix_so_far = np.concatenate(([0], np.cumsum(ends - starts)))
+        num_runs_before = np.searchsorted(ends, pix, side="right") # runs ending at or before pix
+        next_run = np.minimum(num_runs_before, starts.size - 1)
+        partial = np.where(num_runs_before < starts.size, np.maximum(pix - starts[next_run], 0), 0)
+        return run_pix_so_far[num_runs_before] + partial
+
+'''
+RunsMicroImage class gathers the analysis shared by the processing techniques whose processed image can be turned into
+positive runs (see _ret_runs) without building the pixel array. It is a subclass of MicroImageLarge class.
+'''
+class RunsMicroImage(MicroImageLarge):
+
+    # Layout of the table of connected components returned by label_components: area, tight bounding box (end row and
+    # end col excluded), number of vein pixels within the component and their fraction of its area
+    component_dtype = np.dtype([("area", "<u8"), ("row_start", "<u4"), ("col_start", "<u4"), ("row_end", "<u4"),
+                                ("col_end", "<u4"), ("num_vein_pix", "<u8"), ("vein_density", "<f8")])
+
+    def __init__(self, path):
+        super().__init__(path)
+
+    # Turn a processed image into its positive runs without building the pixel array
+    # Parameters:
+    # processed_img: result of _process()
+    # Returns the sorted pixel indices of the first and one-past-the-last pixel of each positive run
+    def _ret_runs(self, processed_img):
+        raise NotImplementedError
+
+    # Generator of the positive runs of a processed image, a chunk of runs at a time, so that a scan that stops early
+    # (see classify_veins_perc) doesn't pay for decoding the rest of the image. By default the whole processed image
+    # is turned into runs up front, the processing techniques that can be walked incrementally override it
+    # Parameters:
+    # processed_img: result of _process()
+    # chunk_runs: approximate number of runs per chunk
+    # Yields the sorted pixel indices of the first and one-past-the-last pixel of the runs of successive chunks
+    def _iter_runs(self, processed_img, chunk_runs=cfg.EARLY_EXIT_CHUNK_RUNS):
+        starts, ends = self._ret_runs(processed_img)
+        for i in range(0, starts.size, chunk_runs):
+            yield starts[i:i + chunk_runs], ends[i:i + chunk_runs]
+
+    # Split positive runs that span several rows into one segment per row
+    # Parameters:
+    # starts, ends: pixel indices of the first and one-past-the-last pixel of each positive run
+    # num_cols: number of columns of the image
+    # Returns the row, first col and one-past-the-last col of every segment
+    def _split_runs_by_row(self, starts, ends, num_cols):
+        first_rows, last_rows = starts // num_cols, (ends - 1) // num_cols
+        num_segments = last_rows - first_rows + 1
+        first_segment = np.cumsum(num_segments) - num_segments
+        run = np.repeat(np.arange(starts.size), num_segments)
+        rows = first_rows[run] + np.arange(num_segments.sum()) - first_segment[run]
+        col_starts = np.maximum(starts[run] - rows * num_cols, 0)
+        col_ends = np.minimum(ends[run] - rows * num_cols, num_cols)
+        return rows, col_starts, col_ends
+
+    # Runs of the processed image, only computed again if the processed image changed, so that decoding an image strip
+    # by strip (see export_tiff) or sampling it again and again (see estimate_veins_perc) doesn't walk the whole
+    # processed image every time
+    def _ret_cached_runs(self):
+        if not self._has_cached_runs():
+            self._cached_runs = self._ret_runs(self.processed)
+            self._cached_runs_of = self.processed
+        return self._cached_runs
+
+    # Whether the runs of the current processed image are cached, see _ret_cached_runs
+    def _has_cached_runs(self):
+        return getattr(self, "_cached_runs_of", None) is self.processed
+
+    # Write the decoded rows into the buffer, one run segment at a time
+    def _decode_rows_into(self, out, row_start, row_stop, packed):
+        header = self._ret_header_fields(self.processed)
+        starts, ends = self._ret_cached_runs()
+        first_pix, last_pix = row_start * header["cols"], row_stop * header["cols"]
+        first_run, last_run = np.searchsorted(ends, first_pix, side="right"), np.searchsorted(starts, last_pix)
+        starts = np.maximum(starts[first_run:last_run], first_pix)
+        ends = np.minimum(ends[first_run:last_run], last_pix)
+        if starts.size:
+            rows, col_starts, col_ends = self._split_runs_by_row(starts - first_pix, ends - first_pix, header["cols"])
+            self._fill_segments(out, rows, col_starts, col_ends, packed)
+
+    # Helper function to convert positive runs to a binary numpy (1 for positive pixel, 0 for background)
+    # Parameters:
+    # starts, ends: pixel indices of the first and one-past-the-last pixel of each positive run
+    # num_rows, num_cols: size of the image
+    def _runs_to_bin_npy(self, starts, ends, num_rows, num_cols):
+        res = np.zeros(num_rows * num_cols + 1, dtype=np.int8)
+        np.add.at(res, starts, 1)
+        np.add.at(res, ends, -1)
+        return np.cumsum(res[:-1], dtype=np.int8).astype(np.uint8).reshape(num_rows, num_cols)
+
+    # helper function to get the number of bytes each non-negative int takes as a LEB128 varint
+    def _varint_sizes(self, values):
+        sizes = np.ones(np.shape(values), dtype=np.int64)
+        values = np.asarray(values) >> 7
+        while values.size and values.max() > 0:
+            sizes += values > 0
+            values = values >> 7
+        return sizes
+
+    # Vectorized LEB128 encoding of non-negative ints: 7 bits per byte, lowest bits first, the highest bit of every
+    # byte but the last of each int is set
+    # Parameters:
+    # values: array of non-negative ints
+    def _encode_varints(self, values):
+        sizes = self._varint_sizes(values)
+        byte_idx = np.arange(sizes.sum()) - np.repeat(np.cumsum(sizes) - sizes, sizes) # byte index within each int
+        res = (np.repeat(values, sizes) >> (7 * byte_idx)) & 0x7f
+        res[byte_idx < np.repeat(sizes, sizes) - 1] |= 0x80
+        return res.astype(np.uint8)
+
+    # Vectorized inverse of _encode_varints
+    # Parameters:
+    # data: array of bytes
+    def _decode_varints(self, data):
+        data = np.asarray(data, dtype=np.int64)
+        ends = np.flatnonzero(data < 0x80) + 1
+        if ends.size == 0:
+            return np.zeros(0, dtype=np.int64)
+        starts = np.concatenate(([0], ends[:-1]))
+        byte_idx = np.arange(ends[-1]) - np.repeat(starts, ends - starts)
+        return np.add.reduceat((data[:ends[-1]] & 0x7f) << (7 * byte_idx), starts)
+
+    # calculate the percentage of veins pixels within the body as it relates to the whole body
+    # Use the runs of the processed body image and the runs of the processed veins image
+    def calc_veins_perc(self, veins_of_this_body):
+        valid_vein = 0
+        for chunk_body_pix, chunk_valid_vein in self._iter_overlap_chunks(veins_of_this_body):
+            valid_vein += chunk_valid_vein
+        return valid_vein / self._count_body_pix() # number of body pixels comes from the header
+
+    # Draw random body pixels by picking random offsets into the concatenated body runs
+    def _sample_body_pix(self, num_samples, rng):
+        starts, ends = self._ret_cached_runs()
+        run_pix_so_far = np.cumsum(ends - starts)
+        if run_pix_so_far.size == 0:
+            return np.zeros(0, dtype=np.int64)
+        offsets = rng.integers(0, run_pix_so_far[-1], num_samples)
+        run = np.searchsorted(run_pix_so_far, offsets, side="right")
+        return starts[run] + offsets - (run_pix_so_far[run] - (ends[run] - starts[run]))
+
+    # Look up whether the given pixel indices fall within a positive run
+    def _is_positive(self, pix):
+        starts, ends = self._ret_cached_runs()
+        run = np.searchsorted(starts, pix, side="right") - 1 # last run starting at or before pix
+        return (run >= 0) & (pix < ends[np.maximum(run, 0)]) if starts.size else np.zeros(np.shape(pix), dtype=bool)
+
+    # Generator of (number of body pixels, number of vein-in-body pixels) for successive chunks of body runs
+    # Use the runs of the processed body image and the runs of the processed veins image. Both are decoded chunk by
+    # chunk (see _iter_runs), the veins only as far as the body runs of the current chunk, so nothing past the chunk
+    # where the scan stops is decoded
+    def _iter_overlap_chunks(self, veins_of_this_body):
+        vein_chunks = veins_of_this_body._iter_runs(veins_of_this_body.processed, cfg.EARLY_EXIT_VEIN_CHUNK_RUNS)
+        vein_starts, vein_ends = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64) # runs that may overlap
+        veins_left = True
+        for chunk_starts, chunk_ends in self._iter_runs(self.processed):
+            if chunk_starts.size == 0:
+                continue
+            new_starts, new_ends = [vein_starts], [vein_ends]
+            while veins_left and (new_ends[-1].size == 0 or new_ends[-1][-1] < chunk_ends[-1]):
+                vein_chunk = next(vein_chunks, None)
+                if vein_chunk is None:
+                    veins_left = False
+                elif vein_chunk[0].size:
+                    new_starts.append(vein_chunk[0])
+                    new_ends.append(vein_chunk[1])
+            vein_starts, vein_ends = np.concatenate(new_starts), np.concatenate(new_ends)
+            valid_vein = self._count_run_pix_before(vein_starts, vein_ends, chunk_ends) - \
+                self._count_run_pix_before(vein_starts, vein_ends, chunk_starts)
+            yield int((chunk_ends - chunk_starts).sum()), int(valid_vein.sum())
+            keep = vein_ends > chunk_ends[-1] # the next body runs start after this chunk
+            vein_starts, vein_ends = vein_starts[keep], vein_ends[keep]
+
+    # Label the connected components of the positive pixels (e.g. the fragments of a body, or the clusters of veins)
+    # straight from the runs: the row segments of the runs are the nodes, the segments of adjacent rows that touch are
+    # linked, and the linked segments are merged with a union-find. No label image is allocated.
+    # Parameters:
+    # veins_of_this_body: the RunsMicroImage veins image of this body, to count the vein pixels of every component
+    # connectivity: 4 (pixels touching by a side) or 8 (pixels touching by a side or a corner)
+    # Returns a structured array of component_dtype, one row per component in the order of their first pixel
+    def label_components(self, veins_of_this_body=None, connectivity=8):
+        if connectivity not in (4, 8):
+            raise ValueError(f"Connectivity must be 4 or 8, not {connectivity}")
+        header = self._ret_header_fields(self.processed)
+        starts, ends = self._ret_runs(self.processed)
+        if starts.size == 0:
+            return np.zeros(0, dtype=self.component_dtype)
+        rows, col_starts, col_ends = self._split_runs_by_row(starts, ends, header["cols"])
+        seg_a, seg_b = self._ret_touching_segments(rows, col_starts, col_ends, header["cols"], connectivity)
+        roots, labels = np.unique(self._union_segments(rows.size, seg_a, seg_b), return_inverse=True)
+        components = np.zeros(roots.size, dtype=self.component_dtype)
+        components["area"] = np.bincount(labels, weights=col_ends - col_starts)
+        for field, values, reduce in (("row_start", rows, np.minimum), ("col_start", col_starts, np.minimum),
+                                      ("row_end", rows + 1, np.maximum), ("col_end", col_ends, np.maximum)):
+            bounds = values[roots].copy() # the root of a component is one of its segments
+            reduce.at(bounds, labels, values)
+            components[field] = bounds
+        if veins_of_this_body is not None:
+            vein_starts, vein_ends = veins_of_this_body._ret_runs(veins_of_this_body.processed)
+            seg_starts = rows * header["cols"] + col_starts
+            seg_ends = rows * header["cols"] + col_ends
+            seg_vein_pix = self._count_run_pix_before(vein_starts, vein_ends, seg_ends) - \
+                self._count_run_pix_before(vein_starts, vein_ends, seg_starts)
+            components["num_vein_pix"] = np.bincount(labels, weights=seg_vein_pix, minlength=roots.size)
+            components["vein_density"] = components["num_vein_pix"] / components["area"]
+        return components
+
+    # Find the pairs of row segments of adjacent rows that touch
+    # Parameters:
+    # rows, col_starts, col_ends: row segments in raster order, see _split_runs_by_row
+    # num_cols: number of columns of the image
+    # connectivity: see label_components
+    # Returns the indices of the upper and lower segment of every pair
+    def _ret_touching_segments(self, rows, col_starts, col_ends, num_cols, connectivity):
+        reach = 1 if connectivity == 8 else 0 # how far past its ends a segment touches the next row
+        row_base = rows * (num_cols + 2)
+        # the segments of a row don't overlap, so both their starts and ends are sorted in raster order
+        next_row_base = (rows + 1) * (num_cols + 2)
+        first = np.searchsorted(row_base + col_ends, next_row_base + col_starts - reach, side="right")
+        last = np.searchsorted(row_base + col_starts, next_row_base + col_ends + reach, side="left")
+        num_touching = np.maximum(last - first, 0)
+        seg_a = np.repeat(np.arange(rows.size), num_touching)
+        seg_b = np.arange(num_touching.sum()) - np.repeat(np.cumsum(num_touching) - num_touching, num_touching) + \
+            np.repeat(first, num_touching)
+        return seg_a, seg_b
+
+    # Vectorized union-find: the root of every linked pair is hooked onto the smaller of the two roots, then the paths
+    # to the roots are compressed, until both segments of every pair share a root
+    # Parameters:
+    # num_segments: number of segments
+    # seg_a, seg_b: indices of the segments of every linked pair
+    # Returns the root (smallest segment index) of the component of every segment
+    def _union_segments(self, num_segments, seg_a, seg_b):
+        parent = np.arange(num_segments)
+        while True:
+            root_a, root_b = parent[seg_a], parent[seg_b]
+            unmerged = root_a != root_b
+            if not unmerged.any():
+                return parent
+            root_a, root_b = root_a[unmerged], root_b[unmerged]
+            np.minimum.at(parent, np.maximum(root_a, root_b), np.minimum(root_a, root_b))
+            while True:
+                grand_parent = parent[parent]
+                if np.array_equal(grand_parent, parent):
+                    break
+                parent = grand_parent
+
+    # Erode the positive pixels with a rectangular structuring element: a pixel stays positive only if the whole
+    # rectangle around it is positive (pixels outside the image count as background). Runs are narrowed within their
+    # row, then the rows are intersected with the rows around them, so the cost scales with the number of runs.
+    # Parameters:
+    # height, width: size of the rectangle, centered on the pixel (one more row or col after it than before it when
+    #                the size is even)
+    # Returns a new MicroImage object made from the processed result, without raw image (see from_processed)
+    def erode(self, height, width):
+        return self._apply_morph([(height, width, True)])
+
+    # Dilate the positive pixels with a rectangular structuring element: a pixel becomes positive if any pixel of the
+    # (reflected) rectangle around it is positive. Runs are widened within their row, then the rows are merged with
+    # the rows around them
+    # Parameters:
+    # height, width: see erode
+    def dilate(self, height, width):
+        return self._apply_morph([(height, width, False)])
+
+    # Morphological opening (erosion then dilation), removes the positive specks smaller than the rectangle
+    # Parameters:
+    # height, width: see erode
+    def opening(self, height, width):
+        return self._apply_morph([(height, width, True), (height, width, False)])
+
+    # Morphological closing (dilation then erosion), fills the background holes and gaps smaller than the rectangle
+    # Parameters:
+    # height, width: see erode
+    def closing(self, height, width):
+        return self._apply_morph([(height, width, False), (height, width, True)])
+
+    # Apply successive erosions and dilations to the runs of the processed image
+    # Parameters:
+    # steps: list of (height, width, erode) of every step
+    def _apply_morph(self, steps):
+        header = self._ret_header_fields(self.processed)
+        starts, ends = self._ret_runs(self.processed)
+        for height, width, erode in steps:
+            if height < 1 or width < 1:
+                raise ValueError(f"Structuring element must be at least 1x1, not {height}x{width}")
+            starts, ends = self._morph_rows_horizontally(starts, ends, header["cols"], width, erode)
+            starts, ends = self._morph_rows_vertically(starts, ends, header["rows"], header["cols"], height, erode)
+        return self._from_runs(starts, ends, header["rows"], header["cols"])
+
+    # Create a new MicroImage object of this processing technique from positive runs
+    # Parameters:
+    # starts, ends: sorted pixel indices of the first and one-past-the-last pixel of each positive run
+    # num_rows, num_cols: size of the image
+    def _from_runs(self, starts, ends, num_rows, num_cols):
+        raise NotImplementedError
+
+    # Narrow (erosion) or widen (dilation) the runs within their rows
+    # Parameters:
+    # starts, ends: merged positive runs
+    # num_cols: number of columns of the image
+    # width: width of the structuring element
+    # erode: whether to erode or dilate
+    # Returns the merged positive runs of the result
+    def _morph_rows_horizontally(self, starts, ends, num_cols, width, erode):
+        rows, col_starts, col_ends = self._split_runs_by_row(starts, ends, num_cols)
+        if erode:
+            col_starts, col_ends = col_starts + (width - 1) // 2, col_ends - width // 2
+        else:
+            col_starts = np.maximum(col_starts - (width - 1) // 2, 0)
+            col_ends = np.minimum(col_ends + width // 2, num_cols)
+        keep = col_ends > col_starts
+        return self._merge_intervals(rows[keep] * num_cols + col_starts[keep], rows[keep] * num_cols + col_ends[keep], 1)
+
+    # Intersect (erosion) or merge (dilation) every row with the rows around it. The rows at distances 0 to height - 1
+    # are combined by doubling: the result so far is combined with a copy of itself shifted by as many rows as it
+    # already spans, so only log2(height) combinations are needed. The result is then shifted back to center it
+    # Parameters:
+    # starts, ends: merged positive runs
+    # num_rows, num_cols: size of the image
+    # height: height of the structuring element
+    # erode: whether to erode or dilate
+    # Returns the merged positive runs of the result
+    def _morph_rows_vertically(self, starts, ends, num_rows, num_cols, height, erode):
+        span, remaining = 1, height - 1
+        while remaining > 0:
+            shift = min(span, remaining)
+            starts, ends = self._merge_intervals(np.concatenate((starts, starts + shift * num_cols)),
+                                                 np.concatenate((ends, ends + shift * num_cols)), 2 if erode else 1)
+            span, remaining = span + shift, remaining - shift
+        back = (height // 2 if erode else (height - 1) // 2) * num_cols
+        starts = np.clip(starts - back, 0, num_rows * num_cols)
+        ends = np.clip(ends - back, 0, num_rows * num_cols)
+        keep = ends > starts
+        return starts[keep], ends[keep]
+
+    # Combine pixel intervals: the result is made of the pixels covered by at least min_cover of the intervals, as
+    # sorted, disjoint and non-touching intervals. min_cover=1 merges the intervals, and min_cover=2 intersects two
+    # sets of disjoint intervals
+    # Parameters:
+    # starts, ends: first and one-past-the-last pixel of every interval, in any order
+    # min_cover: number of intervals that must cover a pixel for it to be kept
+    @staticmethod
+    def _merge_intervals(starts, ends, min_cover):
+        pix = np.concatenate((starts, ends))
+        delta = np.concatenate((np.ones(starts.size, dtype=np.int64), -np.ones(ends.size, dtype=np.int64)))
+        order = np.lexsort((-delta, pix)) # at the same pixel, intervals start before others end
+        pix, covered = pix[order], np.cumsum(delta[order]) >= min_cover
+        was_covered = np.concatenate(([False], covered[:-1]))
+        merged_starts, merged_ends = pix[covered & ~was_covered], pix[~covered & was_covered]
+        keep = merged_ends > merged_starts
+        return merged_starts[keep], merged_ends[keep]
+
+    # Compute the header stats (number of positive pixels and bounding box, see _ret_raw_stats) from positive runs
+    # Parameters:
+    # starts, ends: sorted pixel indices of the first and one-past-the-last pixel of each positive run
+    # num_cols: number of columns of the image
+    def _ret_runs_stats(self, starts, ends, num_cols):
+        stats = {"num_pos_pix": int((ends - starts).sum()), "row_start": 0, "col_start": 0, "row_end": 0, "col_end": 0}
+        if starts.size:
+            rows, col_starts, col_ends = self._split_runs_by_row(starts, ends, num_cols)
+            stats.update(row_start=int(rows[0]), row_end=int(rows[-1]) + 1, col_start=int(col_starts.min()),
+                         col_end=int(col_ends.max()))
+        return stats
+
 '''
 ScanLinesMicroImage class handles the loading, processing, and process validation of parasite images.
-It is a subclass of MicroImageLarge class.
+It is a subclass of RunsMicroImage class.
 '''
-class ScanLinesMicroImage(MicroImageLarge):
+class ScanLinesMicroImage(RunsMicroImage):
 
     name = "scanlines" # Name of MicroImageLarge subclass
     dtype = cfg.SCANLINES_DTYPE # Set dtype being used by this MicroImageLarge subclass (currently "uint16")
+    check_byte = cfg.SCANLINES_CHECKBYTES # Check byte packed at the start of the processed image
 
     def __init__(self, path):
         super().__init__(path)
@@ -112,13 +772,24 @@ class ScanLinesMicroImage(MicroImageLarge):
     def _pix_to_rc(self, pix, numCols):
         return int(pix // numCols), int(pix % numCols)
 
+    # Vectorized helper to turn the number of pixels between successive switches into processed elements, flagging
+    # with a zero every time the count maxes out the dtype before a switch (same as the loop in _process)
+    # Parameters:
+    # gaps: number of pixels between successive switches
+    def _encode_gaps(self, gaps):
+        dtype_max = np.iinfo(self.dtype).max
+        num_flags = (gaps - 1) // dtype_max
+        res = np.zeros(int((num_flags + 1).sum()), dtype=self.dtype)
+        res[np.cumsum(num_flags + 1) - 1] = gaps - num_flags * dtype_max
+        return res
+
     # Process the image using the ScanLines method
     # Taking a scan line approach, record the number of pixels before a pixel value switches from either 0 to 255 or
     # 255 to 0. Even handles cases where the number of pixels before the next switch is larger than what can fit in 
-    # the dtype.
+    # the dtype. An image ending on a positive pixel gets a last switch at the end of the image, to close its last run.
     def _process(self):
         cols, rows = self.raw.size
-        res = [cfg.SCANLINES_CHECKBYTES] + self._make_shape_repr(rows, cols) # Pack check byte and image size
+        res = []
         curr = 255
         curr_count = 0
         first_entry = True
@@ -135,7 +806,10 @@ class ScanLinesMicroImage(MicroImageLarge):
             elif (not first_entry) and ((pix-curr_count) == np.iinfo(self.dtype).max): # max out dtype before a switch
                 res.append(0) # flag it with a zero
                 curr_count = pix
-        return np.array(res, dtype=self.dtype)
+        if (not first_entry) and curr != 255: # ends on a positive pixel, close the last run
+            res.append(rows * cols - curr_count)
+        res = np.array(res, dtype=self.dtype)
+        return np.concatenate((self._make_header(rows, cols, self._ret_raw_stats(), res.size), res)) # Pack header
 
     # Inverse of _process, turns a compressed numpy array to a Pillow image
     # Parameters:
@@ -161,6 +835,27 @@ class ScanLinesMicroImage(MicroImageLarge):
         res_img = self._bin_npy_to_raw(res) # convert binary numpy to Pillow image
         return res_img
 
+    # Create a new ScanLinesMicroImage object from positive runs
+    def _from_runs(self, starts, ends, num_rows, num_cols):
+        return ScanLinesMicroImage.from_processed(self._runs_to_processed(starts, ends, num_rows, num_cols))
+
+    # Vectorized inverse of _ret_runs: build the processed image (header included) of positive runs, the same way as
+    # _process would from the equivalent raw image
+    # Parameters:
+    # starts, ends: sorted pixel indices of the first and one-past-the-last pixel of each positive run
+    # num_rows, num_cols: size of the image
+    def _runs_to_processed(self, starts, ends, num_rows, num_cols):
+        res = np.zeros(0, dtype=self.dtype)
+        if starts.size:
+            switches = np.stack((starts, ends), axis=1).reshape(-1)
+            r, c = self._pix_to_rc(switches[0], num_cols)
+            # max outs between the last switch and the end of the image, none if the last run closes at the end
+            num_flags = max(num_rows * num_cols - 1 - int(switches[-1]), 0) // np.iinfo(self.dtype).max
+            res = np.concatenate((np.array(self._make_shape_repr(r, c), dtype=self.dtype),
+                                  self._encode_gaps(np.diff(switches)), np.zeros(num_flags, dtype=self.dtype)))
+        stats = self._ret_runs_stats(starts, ends, num_cols)
+        return np.concatenate((self._make_header(num_rows, num_cols, stats, res.size), res))
+
     # saves the processed image
     # Parameters:
     # filename: the filename with which to save the processed image
@@ -178,18 +873,20 @@ class ScanLinesMicroImage(MicroImageLarge):
         print(f"num elements : {self.processed.size}")
         print(f"size of each element (bytes): {self.processed.itemsize}")
         print(f"total size of processed data (bytes): {self.processed.nbytes}")
-        print(f"Percentage of original size (%): {self.processed.nbytes / self.raw_size}")
+        if self.raw_size is not None: # no raw image when made from a processed image, e.g. by erode or dilate
+            print(f"Percentage of original size (%): {self.processed.nbytes / self.raw_size}")
         print("")
 
     # calculate the percentage of veins pixels within the body as it relates to the whole body
     # Use ScanLines processed body image and Pillow image generator functionality of veins image
     def calc_veins_perc(self, veins_of_this_body):
+        if veins_of_this_body.raw is None: # e.g. a veins image made by dilate or from_processed, use its runs
+            return super().calc_veins_perc(veins_of_this_body)
         check_byte, data_start_idx, num_rows, num_cols = self._ret_header(self.processed)
         start_idx_so_far, rows_so_far, cols_so_far = self._ret_shape_from_repr(self.processed[data_start_idx:])
         brush = 1 # value of the scan line
         pix_so_far = rows_so_far * num_cols + cols_so_far
         valid_vein = 0 # Number of vein pixels that are within the body of the parasite
-        num_body_pix = 0 # Keep track of number of body pixels
         v = veins_of_this_body.raw.getdata()
         temp = []
         for brush_switch in self.processed[data_start_idx + start_idx_so_far:]:
@@ -198,17 +895,80 @@ class ScanLinesMicroImage(MicroImageLarge):
                     temp = np.array([v[pix_so_far + i] for i in range(np.iinfo(self.dtype).max)])
                     valid_vein += np.sum((255-temp)//255)
                     temp = []
-                    num_body_pix += np.iinfo(self.dtype).max
                 pix_so_far += np.iinfo(self.dtype).max
             else:
                 if brush==1:
                     temp = np.array([v[pix_so_far + i] for i in range(brush_switch)])
                     valid_vein += np.sum((255-temp)//255)
                     temp = []
-                    num_body_pix += brush_switch
                 pix_so_far += brush_switch
                 brush = 1 - brush
-        return valid_vein / num_body_pix # return fraction of vein-in-body to body
+        return valid_vein / self._count_body_pix() # return fraction of vein-in-body to body (read from the header)
+
+    # Turn a processed image into its positive runs without building the pixel array. Vectorized version of the walk
+    # done in _inverse_process.
+    # Parameters:
+    # processed_img: result of _process()
+    # Returns the pixel indices of the first and one-past-the-last pixel of each positive run
+    def _ret_runs(self, processed_img):
+        chunks = list(self._iter_runs(processed_img, chunk_runs=None))
+        if not chunks: # no positive pixels at all
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        return np.concatenate([starts for starts, ends in chunks]), np.concatenate([ends for starts, ends in chunks])
+
+    # Walk the processed image 2 * chunk_runs elements at a time (every run takes at least 2 elements), keeping the
+    # pixel index reached so far and the start of the run left open at the end of the previous chunk
+    # Parameters:
+    # processed_img: result of _process()
+    # chunk_runs: see RunsMicroImage._iter_runs, None to walk the whole processed image at once
+    def _iter_runs(self, processed_img, chunk_runs=cfg.EARLY_EXIT_CHUNK_RUNS):
+        check_byte, data_start_idx, num_rows, num_cols = self._ret_header(processed_img)
+        if processed_img.size == data_start_idx: # no positive pixels at all
+            return
+        start_idx_so_far, rows_so_far, cols_so_far = self._ret_shape_from_repr(processed_img[data_start_idx:])
+        pix_so_far = rows_so_far * num_cols + cols_so_far
+        open_start = pix_so_far # start of the run the brush is drawing, None while it draws background
+        brush_switches = processed_img[data_start_idx + start_idx_so_far:]
+        chunk_elements = max(brush_switches.size, 1) if chunk_runs is None else 2 * chunk_runs
+        dtype_max = np.iinfo(self.dtype).max
+        for i in range(0, brush_switches.size, chunk_elements):
+            chunk = brush_switches[i:i + chunk_elements].astype(np.int64)
+            is_switch = chunk != 0 # zeros flag a dtype max out, they do not switch the brush
+            chunk_pix = pix_so_far + np.cumsum(np.where(is_switch, chunk, dtype_max))
+            pix_so_far = int(chunk_pix[-1])
+            bounds = chunk_pix[is_switch]
+            if open_start is not None:
+                bounds = np.concatenate(([open_start], bounds))
+            open_start = int(bounds[-1]) if bounds.size % 2 else None
+            starts, ends = bounds[0:bounds.size - bounds.size % 2:2], bounds[1::2]
+            non_empty = ends > starts
+            yield starts[non_empty], ends[non_empty]
+        if open_start is not None and pix_so_far > open_start: # last run is not closed by a switch, it goes on
+            yield np.array([open_start], dtype=np.int64), np.array([pix_so_far], dtype=np.int64) # until the last max out
+
+    # Look up whether the given pixel indices are positive straight from the processed elements, unless the runs are
+    # already cached: a pixel is positive if an even number of brush switches come between the first positive pixel
+    # and it, which only takes the running sum of the elements instead of building the runs
+    def _is_positive(self, pix):
+        if self._has_cached_runs():
+            return super()._is_positive(pix)
+        check_byte, data_start_idx, num_rows, num_cols = self._ret_header(self.processed)
+        pix = np.asarray(pix)
+        if self.processed.size == data_start_idx: # no positive pixels at all
+            return np.zeros(pix.shape, dtype=bool)
+        start_idx_so_far, rows_so_far, cols_so_far = self._ret_shape_from_repr(self.processed[data_start_idx:])
+        first_pix = rows_so_far * num_cols + cols_so_far
+        brush_switches = self.processed[data_start_idx + start_idx_so_far:]
+        max_outs = np.flatnonzero(brush_switches == 0) # zeros flag a dtype max out, they do not switch the brush
+        pix_so_far = brush_switches.astype(np.int64)
+        pix_so_far[max_outs] = np.iinfo(self.dtype).max
+        np.cumsum(pix_so_far, out=pix_so_far)
+        pix_so_far += first_pix # pixel index reached after every element
+        num_elements = np.searchsorted(pix_so_far, pix, side="right") # elements fully drawn before pix
+        num_switches = num_elements - np.searchsorted(max_outs, num_elements)
+        # past the last element the image is background, even if the last run is not closed by a switch
+        last_pix = pix_so_far[-1] if pix_so_far.size else first_pix
+        return (pix >= first_pix) & (pix < last_pix) & (num_switches % 2 == 0)
 
 '''
 BitMapMicroImage class handles the loading, processing, and process validation of parasite images.
@@ -218,6 +978,7 @@ class BitMapMicroImage(MicroImageLarge):
 
     name = "bitmap" # Name of MicroImageLarge subclass
     dtype = cfg.BITMAP_DTYPE # Set dtype being used by this MicroImageLarge subclass (currently "uint8")
+    check_byte = cfg.BITMAP_CHECKBYTES # Check byte packed at the start of the processed image
 
     def __init__(self, path):
         super().__init__(path)
@@ -227,7 +988,7 @@ class BitMapMicroImage(MicroImageLarge):
     # Also packs in a header of check byte and size of original image
     def _process(self):
         cols, rows = self.raw.size
-        res = [cfg.BITMAP_CHECKBYTES] + self._make_shape_repr(rows, cols)
+        res = []
         buffer = []
         for pix, val in enumerate(self.raw.getdata()):
             buffer.append(1-val//255)
@@ -235,7 +996,8 @@ class BitMapMicroImage(MicroImageLarge):
                 bin_int = int("".join(map(str, buffer)), 2) # convert the base 2 value to base 10
                 res.append(bin_int)
                 buffer = []
-        return np.array(res, dtype=self.dtype)
+        res = np.array(res, dtype=self.dtype)
+        return np.concatenate((self._make_header(rows, cols, self._ret_raw_stats(), res.size), res))
 
     # Inverse of _process, turns a compressed numpy array to a Pillow image
     # Parameters:
@@ -277,22 +1039,632 @@ class BitMapMicroImage(MicroImageLarge):
         print(f"num elements : {self.processed.size}")
         print(f"size of each element (bytes): {self.processed.itemsize}")
         print(f"total size of processed data (bytes): {self.processed.nbytes}")
-        print(f"Percentage of original size (%): {self.processed.nbytes / self.raw_size}")
+        if self.raw_size is not None: # no raw image when made from a processed image, e.g. by erode or dilate
+            print(f"Percentage of original size (%): {self.processed.nbytes / self.raw_size}")
         print("")
 
     # calculate the percentage of veins pixels within the body as it relates to the whole body
     # Use BitMap processed image of body and and BitMap processed image of veins
+    # Only the bytes within the rows of the body's bounding box are visited
     def calc_veins_perc(self, veins_of_this_body):
         check_byte, data_start_idx, num_rows, num_cols = self._ret_header(self.processed)
         valid_vein = 0
-        num_body_pix = 0
-        cols, rows = self.raw.size
-        for body_pix, vein_pix in zip(self.processed[data_start_idx:], veins_of_this_body.processed[data_start_idx:]):
+        byte_start, byte_end = self._ret_bbox_bytes()
+        for body_pix, vein_pix in zip(self.processed[data_start_idx + byte_start:data_start_idx + byte_end],
+                                      veins_of_this_body.processed[data_start_idx + byte_start:data_start_idx + byte_end]):
             valid_vein += sum([int(c) for c in bin(body_pix & vein_pix)[2:]])
-            num_body_pix += sum([int(c) for c in bin(body_pix)[2:]])
-        return valid_vein / num_body_pix
+        return valid_vein / self._count_body_pix() # number of body pixels comes from the header
+
+    # Range of bytes of processed data covering the rows of the bounding box in the header
+    def _ret_bbox_bytes(self):
+        header = self._ret_header_fields(self.processed)
+        return header["row_start"] * header["cols"] // 8, -(-header["row_end"] * header["cols"] // 8)
+
+    # Draw random body pixels by rejection: draw random pixels of the bounding box in the header and keep the
+    # positive ones
+    def _sample_body_pix(self, num_samples, rng):
+        header = self._ret_header_fields(self.processed)
+        num_pix = (self.processed.size - header["data_start_idx"]) * 8
+        body_pix = np.zeros(0, dtype=np.int64)
+        for attempt in range(cfg.APPROX_MAX_DRAWS):
+            if body_pix.size >= num_samples or header["num_pos_pix"] == 0:
+                break
+            pix = rng.integers(header["row_start"], header["row_end"], 2 * num_samples) * header["cols"] + \
+                rng.integers(header["col_start"], header["col_end"], 2 * num_samples)
+            pix = pix[pix < num_pix]
+            body_pix = np.concatenate((body_pix, pix[self._is_positive(pix)]))
+        return body_pix[:num_samples]
+
+    # Look up the bits of the given pixel indices. The pixels of the incomplete last byte are not stored (see _process),
+    # they are background
+    def _is_positive(self, pix):
+        check_byte, data_start_idx, num_rows, num_cols = self._ret_header(self.processed)
+        pix = np.asarray(pix)
+        stored = (pix >> 3) < self.processed.size - data_start_idx
+        packed = self.processed[data_start_idx + np.where(stored, pix >> 3, 0)]
+        return stored & ((packed >> (7 - (pix & 7))) & 1).astype(bool)
 
-# Auxiliary class to show how this framework can be extended
+    # Write the decoded rows into the buffer, cfg.DECODE_CHUNK_ROWS rows at a time. When the rows are byte-aligned, a
+    # packed buffer is a straight copy of the processed bytes.
+    def _decode_rows_into(self, out, row_start, row_stop, packed):
+        header = self._ret_header_fields(self.processed)
+        data = self.processed[header["data_start_idx"]:]
+        num_cols = header["cols"]
+        if packed and num_cols % 8 == 0:
+            row_bytes = num_cols // 8
+            stored = data[row_start * row_bytes:row_stop * row_bytes] # the last incomplete byte is never stored
+            out.reshape(-1)[:stored.size] = stored
+            return
+        for chunk_start in range(row_start, row_stop, cfg.DECODE_CHUNK_ROWS):
+            chunk_stop = min(chunk_start + cfg.DECODE_CHUNK_ROWS, row_stop)
+            first_pix, last_pix = chunk_start * num_cols, min(chunk_stop * num_cols, data.size * 8)
+            if last_pix <= first_pix:
+                break
+            bits = np.unpackbits(data[first_pix >> 3:-(-last_pix // 8)])[first_pix & 7:(first_pix & 7) + last_pix - first_pix]
+            chunk_out = out[chunk_start - row_start:chunk_stop - row_start]
+            if packed:
+                bits = np.concatenate((bits, np.zeros((chunk_stop - chunk_start) * num_cols - bits.size, np.uint8)))
+                chunk_out[:] = np.packbits(bits.reshape(-1, num_cols), axis=1)
+            else:
+                chunk_out.reshape(-1)[:bits.size] = bits
+
+    # Generator of (number of body pixels, number of vein-in-body pixels) for successive chunks of bytes
+    # Use BitMap processed image of body and BitMap processed image of veins
+    def _iter_overlap_chunks(self, veins_of_this_body):
+        if not isinstance(veins_of_this_body, BitMapMicroImage):
+            raise ValueError("Byte by byte overlap of a BitMap body needs BitMap veins")
+        check_byte, data_start_idx, num_rows, num_cols = self._ret_header(self.processed)
+        byte_start, byte_end = self._ret_bbox_bytes() # the rest of the image holds no body pixels
+        body = self.processed[data_start_idx + byte_start:data_start_idx + byte_end]
+        veins = veins_of_this_body.processed[data_start_idx + byte_start:data_start_idx + byte_end]
+        for i in range(0, body.size, cfg.EARLY_EXIT_CHUNK_BYTES):
+            body_chunk = body[i:i + cfg.EARLY_EXIT_CHUNK_BYTES]
+            veins_chunk = veins[i:i + cfg.EARLY_EXIT_CHUNK_BYTES]
+            yield int(np.unpackbits(body_chunk).sum()), int(np.unpackbits(body_chunk & veins_chunk).sum())
+
+'''
+VerticalDeltaMicroImage class handles the loading, processing, and process validation of parasite images.
+It is a subclass of RunsMicroImage class.
+'''
+class VerticalDeltaMicroImage(RunsMicroImage):
+
+    name = "vdelta" # Name of MicroImageLarge subclass
+    dtype = cfg.VDELTA_DTYPE # Set dtype being used by this MicroImageLarge subclass (currently "uint8")
+    check_byte = cfg.VDELTA_CHECKBYTES # Check byte packed at the start of the processed image
+
+    # Row codes, stored in the 2 lowest bits of the first varint of each coded row
+    REPEAT = 0 # the previous row repeats (code >> 2) times
+    VERTICAL = 1 # same number of transitions as the previous row, followed by the zigzag deltas to its transitions
+    HORIZONTAL = 2 # (code >> 2) transitions, followed by the first transition column and the gaps between the others
+
+    def __init__(self, path):
+        super().__init__(path)
+
+    # Process the image using the VerticalDelta method
+    # In the spirit of CCITT G4/READ coding, every row is reduced to its transitions (columns where the pixel value
+    # switches, starting from background) and coded relative to the previous row: rows identical to the previous one
+    # are only counted, rows with the same number of transitions store how far each transition moved, and the other
+    # rows store their transitions as gaps. Everything is stored as LEB128 varints so that the small deltas of smooth
+    # body shapes take a single byte. Rows are read in bands of cfg.VDELTA_BAND_ROWS rows.
+    def _process(self):
+        cols, rows = self.raw.size
+        res = self._encode_varints(self._code_rows(*self._ret_raw_transitions(), rows))
+        return np.concatenate((self._make_header(rows, cols, self._ret_raw_stats(), res.size), res)) # Pack header
+
+    # Find the transitions of every row of the raw image, reading it in bands of cfg.VDELTA_BAND_ROWS rows
+    # Returns the row and column of every transition, in raster order
+    def _ret_raw_transitions(self):
+        cols, rows = self.raw.size
+        band_trans_rows, band_trans_cols = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)]
+        for band_start in range(0, rows, cfg.VDELTA_BAND_ROWS):
+            band_end = min(band_start + cfg.VDELTA_BAND_ROWS, rows)
+            bin_band = (1 - np.asarray(self.raw.crop((0, band_start, cols, band_end))) // 255).astype(np.int8)
+            trans_rows, trans_cols = np.nonzero(np.diff(bin_band, axis=1, prepend=0))
+            band_trans_rows.append(trans_rows.astype(np.int64) + band_start)
+            band_trans_cols.append(trans_cols.astype(np.int64))
+        return np.concatenate(band_trans_rows), np.concatenate(band_trans_cols)
+
+    # Code every row relative to the previous one (see _process), for all the rows at once: a row with as many
+    # transitions as the previous row finds the transition it moved from at the same offset back in the flat
+    # transitions, so the deltas, the row repeats and the cheaper of the two codings of every row are all found with
+    # array operations
+    # Parameters:
+    # trans_rows, trans_cols: row and column of every transition, in raster order
+    # num_rows: number of rows of the image
+    # Returns the codes, to be stored as varints
+    def _code_rows(self, trans_rows, trans_cols, num_rows):
+        num_trans = np.bincount(trans_rows, minlength=num_rows)
+        first_trans = np.cumsum(num_trans) - num_trans
+        gaps = np.diff(trans_cols, prepend=0)
+        gaps[first_trans[num_trans > 0]] = trans_cols[first_trans[num_trans > 0]]
+        # the row before the first one is all background
+        same_size = num_trans == np.concatenate(([0], num_trans[:-1]))
+        same_size_trans = np.flatnonzero(same_size[trans_rows])
+        deltas = trans_cols[same_size_trans] - trans_cols[same_size_trans - num_trans[trans_rows[same_size_trans]]]
+        repeats = same_size & (np.bincount(trans_rows[same_size_trans[deltas != 0]], minlength=num_rows) == 0)
+        # the vertical coding is kept when it takes no more bytes than the gaps
+        moved = ~repeats[trans_rows[same_size_trans]]
+        moved_trans, deltas = same_size_trans[moved], self._zigzag(deltas[moved])
+        vertical = same_size & ~repeats & (np.bincount(trans_rows[moved_trans], self._varint_sizes(deltas), num_rows) <=
+                                           np.bincount(trans_rows[moved_trans], self._varint_sizes(gaps[moved_trans]),
+                                                       num_rows))
+        values = gaps
+        values[moved_trans[vertical[trans_rows[moved_trans]]]] = deltas[vertical[trans_rows[moved_trans]]]
+        # every group of repeated rows takes one code, every other row one code followed by its values
+        group_bounds = np.flatnonzero(np.diff(np.concatenate(([0], repeats, [0])).astype(np.int8)))
+        repeat_starts, repeat_ends = group_bounds[0::2], group_bounds[1::2]
+        row_sizes = np.where(repeats, 0, num_trans + 1)
+        row_sizes[repeat_starts] = 1
+        row_codes_idx = np.cumsum(row_sizes) - row_sizes
+        codes = np.empty(int(row_sizes.sum()), dtype=np.int64)
+        codes[row_codes_idx[repeat_starts]] = (repeat_ends - repeat_starts) << 2 | self.REPEAT
+        coded_rows = np.flatnonzero(~repeats)
+        codes[row_codes_idx[coded_rows]] = np.where(vertical[coded_rows], self.VERTICAL,
+                                                    num_trans[coded_rows] << 2 | self.HORIZONTAL)
+        trans_codes_idx = np.repeat(row_codes_idx + 1 - first_trans, num_trans) + np.arange(trans_cols.size)
+        if repeats.any():
+            coded_trans = np.flatnonzero(~repeats[trans_rows])
+            trans_codes_idx, values = trans_codes_idx[coded_trans], values[coded_trans]
+        codes[trans_codes_idx] = values
+        return codes
+
+    # Create a new VerticalDeltaMicroImage object from positive runs
+    def _from_runs(self, starts, ends, num_rows, num_cols):
+        return VerticalDeltaMicroImage.from_processed(self._runs_to_processed(starts, ends, num_rows, num_cols))
+
+    # Build the processed image (header included) of positive runs, the same way as _process would from the
+    # equivalent raw image
+    # Parameters:
+    # starts, ends: sorted pixel indices of the first and one-past-the-last pixel of each positive run
+    # num_rows, num_cols: size of the image
+    def _runs_to_processed(self, starts, ends, num_rows, num_cols):
+        rows, col_starts, col_ends = self._split_runs_by_row(starts, ends, num_cols)
+        trans = np.stack((col_starts, col_ends), axis=1).reshape(-1)
+        trans_rows = np.repeat(rows, 2)
+        keep = trans < num_cols # a row ending on a positive pixel has no transition at its end
+        res = self._encode_varints(self._code_rows(trans_rows[keep], trans[keep], num_rows))
+        stats = self._ret_runs_stats(starts, ends, num_cols)
+        return np.concatenate((self._make_header(num_rows, num_cols, stats, res.size), res))
+
+    # Inverse of _process, turns a compressed numpy array to a Pillow image
+    # Parameters:
+    # processed_img: result of _process()
+    def _inverse_process(self, processed_img):
+        check_byte, data_start_idx, num_rows, num_cols = self._ret_header(processed_img)
+        starts, ends = self._ret_runs(processed_img)
+        return self._bin_npy_to_raw(self._runs_to_bin_npy(starts, ends, num_rows, num_cols))
+
+    # Turn a processed image into its positive runs, by pairing up the transitions of every row (a row that ends on a
+    # positive pixel is closed at its last column)
+    def _ret_runs(self, processed_img):
+        chunks = list(self._iter_runs(processed_img, chunk_runs=None))
+        if not chunks:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        return np.concatenate([starts for starts, ends in chunks]), np.concatenate([ends for starts, ends in chunks])
+
+    # Walk the row codes, yielding the runs every time the rows walked so far hold at least chunk_runs runs. Where
+    # the codes of a row start depends on the number of transitions of the rows before it, so the walk itself is a loop
+    # over the row codes, that only reads the first code of every row (or group of repeated rows). The transitions of
+    # the rows walked are then decoded all at once, see _decode_row_groups
+    # Parameters:
+    # processed_img: result of _process()
+    # chunk_runs: see RunsMicroImage._iter_runs, None to walk all the rows at once
+    def _iter_runs(self, processed_img, chunk_runs=cfg.EARLY_EXIT_CHUNK_RUNS):
+        check_byte, data_start_idx, num_rows, num_cols = self._ret_header(processed_img)
+        if check_byte != cfg.VDELTA_CHECKBYTES: # Ensure correct checbytes
+            raise ValueError("Check bytes for vertical delta inverse process are incorrect")
+        codes = self._decode_varints(processed_img[data_start_idx:])
+        prev = np.zeros(0, dtype=np.int64) # transitions of the last coded row of the previous chunk
+        row, i = 0, 0
+        while row < num_rows:
+            groups = [] # (first row, number of rows, index of the first code, code) of every group of rows walked
+            num_trans, num_bounds = prev.size, 0
+            while row < num_rows and (chunk_runs is None or num_bounds < 2 * chunk_runs):
+                code = int(codes[i])
+                num_same_rows = code >> 2 if code & 3 == self.REPEAT else 1
+                if code & 3 == self.HORIZONTAL:
+                    num_trans = code >> 2
+                groups.append((row, num_same_rows, i, code))
+                num_bounds += (num_trans + num_trans % 2) * num_same_rows
+                i += 1 if code & 3 == self.REPEAT else 1 + num_trans
+                row += num_same_rows
+            groups = np.array(groups, dtype=np.int64).reshape(-1, 4)
+            starts, ends, prev = self._decode_row_groups(codes, groups, prev, num_cols)
+            if starts.size:
+                yield starts, ends
+
+    # Decode the transitions of successive groups of rows walked by _iter_runs, and turn them into runs
+    # Parameters:
+    # codes: the decoded varints of the processed image
+    # groups: (first row, number of rows, index of the first code, code) of every group of rows
+    # prev: transitions of the row before the first group
+    # num_cols: number of columns of the image
+    # Returns the runs of the rows, and the transitions of the last row
+    def _decode_row_groups(self, codes, groups, prev, num_cols):
+        # coded rows, after prev as an extra first row holding columns, that the repeated rows before the first coded
+        # row copy. A horizontal row and the vertical rows following it make a chain of rows of as many transitions
+        is_coded = groups[:, 3] & 3 != self.REPEAT
+        coded = np.flatnonzero(is_coded)
+        is_horizontal = np.concatenate(([True], groups[coded, 3] & 3 == self.HORIZONTAL))
+        chain_first_row = np.flatnonzero(is_horizontal)
+        row_chain = np.cumsum(is_horizontal) - 1
+        row_num_trans = np.concatenate(([prev.size], groups[coded, 3] >> 2))[chain_first_row][row_chain]
+        row_first_trans = np.cumsum(row_num_trans) - row_num_trans
+        trans_row = np.repeat(np.arange(row_chain.size), row_num_trans)
+        offsets = np.arange(trans_row.size) - row_first_trans[trans_row]
+        # prev is stored like a horizontal row, as gaps
+        values = np.concatenate((np.diff(prev, prepend=0),
+                                 codes[np.repeat(groups[coded, 2] + 1, row_num_trans[1:]) + offsets[prev.size:]]))
+        # gaps of the horizontal rows to columns
+        trans_horizontal = is_horizontal[trans_row]
+        gaps = values if is_horizontal.all() else np.where(trans_horizontal, values, 0)
+        gap_sums = np.cumsum(gaps)
+        columns = gap_sums - np.repeat(np.concatenate(([0], gap_sums))[row_first_trans], row_num_trans)
+        values = columns if is_horizontal.all() else np.where(trans_horizontal, columns, values)
+        chain_num_rows = np.diff(np.append(chain_first_row, row_chain.size))
+        if (chain_num_rows > 1).any(): # vertical rows to decode
+            # the transitions of a chain of several rows are a matrix of one row per coded row: laid out column by
+            # column, the deltas are summed down the columns with a single running sum
+            chains = np.flatnonzero(chain_num_rows > 1)
+            chain_num_trans = row_num_trans[chain_first_row[chains]] * chain_num_rows[chains]
+            chain_trans = np.repeat(row_first_trans[chain_first_row[chains]] - np.cumsum(chain_num_trans) +
+                                    chain_num_trans, chain_num_trans) + np.arange(int(chain_num_trans.sum()))
+            trans_chain = row_chain[trans_row[chain_trans]]
+            chain_values = values[chain_trans]
+            vertical = ~is_horizontal[trans_row[chain_trans]]
+            chain_values[vertical] = self._unzigzag(chain_values[vertical])
+            row_in_chain = trans_row[chain_trans] - chain_first_row[trans_chain]
+            by_column = np.repeat(np.cumsum(chain_num_trans) - chain_num_trans, chain_num_trans) + \
+                offsets[chain_trans] * chain_num_rows[trans_chain] + row_in_chain
+            column_values = np.empty_like(chain_values)
+            column_values[by_column] = chain_values
+            column_sums = np.cumsum(column_values)
+            column_start = by_column - row_in_chain
+            values[chain_trans] = column_sums[by_column] - column_sums[column_start] + column_values[column_start]
+        last_row_trans = values[row_first_trans[-1]:row_first_trans[-1] + row_num_trans[-1]]
+        # runs of every coded row, the last one closed at the end of the row if needed
+        row_num_runs = (row_num_trans + 1) // 2
+        row_first_run = np.cumsum(row_num_runs) - row_num_runs
+        open_rows = np.flatnonzero(row_num_trans % 2)
+        bounds = np.insert(values, row_first_trans[open_rows] + row_num_trans[open_rows], num_cols)
+        col_starts, col_ends = bounds[0::2], bounds[1::2]
+        if is_coded.all(): # every group is a single coded row, prev is not repeated
+            row_pix = np.repeat(groups[:, 0] * num_cols, row_num_runs[1:])
+            return row_pix + col_starts[row_first_run[1]:], row_pix + col_ends[row_first_run[1]:], last_row_trans
+        # every group of rows repeats the runs of its coded row
+        rows = groups[0, 0] + np.arange(int(groups[:, 1].sum())) # the groups follow each other
+        rows_coded_row = np.repeat(np.cumsum(is_coded), groups[:, 1])
+        rows_num_runs = row_num_runs[rows_coded_row]
+        run_row = np.repeat(np.arange(rows.size), rows_num_runs)
+        run_idx = np.arange(run_row.size) + np.repeat(row_first_run[rows_coded_row] - np.cumsum(rows_num_runs) +
+                                                      rows_num_runs, rows_num_runs)
+        row_pix = rows[run_row] * num_cols
+        return row_pix + col_starts[run_idx], row_pix + col_ends[run_idx], last_row_trans
+
+    # helper function to map signed ints to unsigned ints, small magnitudes to small values (0, -1, 1, -2 => 0, 1, 2, 3)
+    def _zigzag(self, values):
+        return (values << 1) ^ (values >> 63)
+
+    # inverse of _zigzag
+    def _unzigzag(self, values):
+        return (values >> 1) ^ -(values & 1)
+
+    # saves the processed image
+    # Parameters:
+    # filename: the filename with which to save the processed image
+    def save_processed_img(self, filename):
+        path = os.path.join(cfg.PROCESSED_DIR, f"{filename}.npy")
+        np.save(path, self.processed)
+
+    # print the memory usage of the raw and processed images, as well as the compression rate
+    def print_memory(self):
+        print("---RAW---")
+        print(f"total size of raw data (bytes): {self.raw_size}")
+        print("")
+
+        print("---PROCESSED---")
+        print(f"num elements : {self.processed.size}")
+        print(f"size of each element (bytes): {self.processed.itemsize}")
+        print(f"total size of processed data (bytes): {self.processed.nbytes}")
+        if self.raw_size is not None: # no raw image when made from a processed image, e.g. by erode or dilate
+            print(f"Percentage of original size (%): {self.processed.nbytes / self.raw_size}")
+        print("")
+
+'''
+SparseMicroImage class handles the loading, processing, and process validation of parasite images that are mostly
+background, like the thin strands of veins images. It is a subclass of RunsMicroImage class.
+'''
+class SparseMicroImage(RunsMicroImage):
+
+    name = "sparse" # Name of MicroImageLarge subclass
+    dtype = cfg.SPARSE_DTYPE # Set dtype being used by this MicroImageLarge subclass (currently "uint8")
+    check_byte = cfg.SPARSE_CHECKBYTES # Check byte packed at the start of the processed image
+
+    def __init__(self, path):
+        super().__init__(path)
+
+    # Process the image using the Sparse method
+    # Only the rows holding positive pixels are stored, each one as a list of spans of positive pixels:
+    # number of rows since the previous stored row, number of spans, then (gap since the end of the previous span,
+    # length) for every span. Everything is stored as LEB128 varints, so the cost is proportional to the number of
+    # spans instead of the size of the frame. Rows are read in bands of cfg.SPARSE_BAND_ROWS rows.
+    def _process(self):
+        cols, rows = self.raw.size
+        codes = []
+        prev_row = -1
+        for band_start in range(0, rows, cfg.SPARSE_BAND_ROWS):
+            band_end = min(band_start + cfg.SPARSE_BAND_ROWS, rows)
+            bin_band = (1 - np.asarray(self.raw.crop((0, band_start, cols, band_end))) // 255).astype(np.int8)
+            # pad with background on both sides so that every row has an even number of transitions
+            trans_rows, trans_cols = np.nonzero(np.diff(bin_band, axis=1, prepend=0, append=0))
+            if trans_rows.size == 0:
+                continue
+            span_rows = trans_rows[0::2] + band_start
+            codes.append(self._code_spans(span_rows, trans_cols[0::2], trans_cols[1::2], prev_row))
+            prev_row = span_rows[-1]
+        codes = np.concatenate(codes) if codes else np.zeros(0, dtype=np.int64)
+        res = self._encode_varints(codes)
+        return np.concatenate((self._make_header(rows, cols, self._ret_raw_stats(), res.size), res)) # Pack header
+
+    # Code the spans of positive pixels of successive rows (see _process)
+    # Parameters:
+    # span_rows, span_starts, span_ends: row, first col and one-past-the-last col of every span, in raster order
+    # prev_row: the last row coded before these spans, -1 if none
+    # Returns the codes, to be stored as varints
+    def _code_spans(self, span_rows, span_starts, span_ends, prev_row):
+        span_rows_ls, num_spans = np.unique(span_rows, return_counts=True)
+        first_span = np.cumsum(num_spans) - num_spans
+        prev_ends = np.concatenate(([0], span_ends[:-1]))
+        prev_ends[first_span] = 0 # the first span of a row is relative to the start of the row
+        # interleave the row headers with the spans of each row
+        codes = np.zeros(2 * (span_rows_ls.size + span_starts.size), dtype=np.int64)
+        header_pos = 2 * (np.arange(span_rows_ls.size) + first_span)
+        codes[header_pos] = np.diff(span_rows_ls, prepend=prev_row)
+        codes[header_pos + 1] = num_spans
+        span_pos = 2 * (np.arange(span_starts.size) + np.repeat(np.arange(span_rows_ls.size) + 1, num_spans))
+        codes[span_pos] = span_starts - prev_ends
+        codes[span_pos + 1] = span_ends - span_starts
+        return codes
+
+    # Create a new SparseMicroImage object from positive runs
+    def _from_runs(self, starts, ends, num_rows, num_cols):
+        return SparseMicroImage.from_processed(self._runs_to_processed(starts, ends, num_rows, num_cols))
+
+    # Build the processed image (header included) of positive runs, the same way as _process would from the
+    # equivalent raw image
+    # Parameters:
+    # starts, ends: sorted pixel indices of the first and one-past-the-last pixel of each positive run
+    # num_rows, num_cols: size of the image
+    def _runs_to_processed(self, starts, ends, num_rows, num_cols):
+        rows, col_starts, col_ends = self._split_runs_by_row(starts, ends, num_cols)
+        codes = self._code_spans(rows, col_starts, col_ends, -1) if rows.size else np.zeros(0, dtype=np.int64)
+        res = self._encode_varints(codes)
+        stats = self._ret_runs_stats(starts, ends, num_cols)
+        return np.concatenate((self._make_header(num_rows, num_cols, stats, res.size), res))
+
+    # Inverse of _process, turns a compressed numpy array to a Pillow image
+    # Parameters:
+    # processed_img: result of _process()
+    def _inverse_process(self, processed_img):
+        check_byte, data_start_idx, num_rows, num_cols = self._ret_header(processed_img)
+        starts, ends = self._ret_runs(processed_img)
+        return self._bin_npy_to_raw(self._runs_to_bin_npy(starts, ends, num_rows, num_cols))
+
+    # Turn a processed image into its positive runs, one per span
+    def _ret_runs(self, processed_img):
+        check_byte, data_start_idx, num_rows, num_cols = self._ret_header(processed_img)
+        if check_byte != cfg.SPARSE_CHECKBYTES: # Ensure correct checbytes
+            raise ValueError("Check bytes for sparse inverse process are incorrect")
+        codes = self._decode_varints(processed_img[data_start_idx:])
+        header_pos = []
+        i, codes_ls = 0, codes.tolist()
+        while i < len(codes_ls): # hop from row header to row header
+            header_pos.append(i)
+            i += 2 + 2 * codes_ls[i + 1]
+        header_pos = np.array(header_pos, dtype=np.int64)
+        if header_pos.size == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        rows = np.cumsum(codes[header_pos]) - 1
+        num_spans = codes[header_pos + 1]
+        first_span = np.cumsum(num_spans) - num_spans
+        span_row = np.repeat(np.arange(header_pos.size), num_spans)
+        span_pos = header_pos[span_row] + 2 + 2 * (np.arange(num_spans.sum()) - first_span[span_row])
+        gaps, lengths = codes[span_pos], codes[span_pos + 1]
+        span_ends = np.cumsum(gaps + lengths)
+        span_ends -= np.repeat(span_ends[first_span] - gaps[first_span] - lengths[first_span], num_spans)
+        starts = rows[span_row] * num_cols + span_ends - lengths
+        return starts, starts + lengths
+
+    # calculate the percentage of veins pixels within the body as it relates to the whole body, with this image being
+    # the veins. Only the vein pixels are visited: they are looked up in the runs of a RunsMicroImage body, or one by
+    # one in any other body (e.g. BitMap).
+    # Parameters:
+    # body: the MicroImageLarge body image of these veins
+    def calc_perc_of_body(self, body):
+        starts, ends = self._ret_runs(self.processed)
+        if isinstance(body, RunsMicroImage):
+            body_starts, body_ends = body._ret_runs(body.processed)
+            valid_vein = (self._count_run_pix_before(body_starts, body_ends, ends) -
+                          self._count_run_pix_before(body_starts, body_ends, starts)).sum()
+        else:
+            lengths = ends - starts
+            vein_pix = np.arange(lengths.sum()) + np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+            valid_vein = body._is_positive(vein_pix).sum()
+        return int(valid_vein) / body._count_body_pix()
+
+    # saves the processed image
+    # Parameters:
+    # filename: the filename with which to save the processed image
+    def save_processed_img(self, filename):
+        path = os.path.join(cfg.PROCESSED_DIR, f"{filename}.npy")
+        np.save(path, self.processed)
+
+    # print the memory usage of the raw and processed images, as well as the compression rate
+    def print_memory(self):
+        print("---RAW---")
+        print(f"total size of raw data (bytes): {self.raw_size}")
+        print("")
+
+        print("---PROCESSED---")
+        print(f"num elements : {self.processed.size}")
+        print(f"size of each element (bytes): {self.processed.itemsize}")
+        print(f"total size of processed data (bytes): {self.processed.nbytes}")
+        if self.raw_size is not None: # no raw image when made from a processed image, e.g. by erode or dilate
+            print(f"Percentage of original size (%): {self.processed.nbytes / self.raw_size}")
+        print("")
+
+'''
+StreamMicroImage class processes an image that arrives incrementally, as successive strips of rows (e.g. from a live
+microscope feed), instead of from a complete file on disk. It is meant to be combined with a MicroImageLarge subclass,
+and produces the exact same processed image as that subclass' _process.
+'''
+class StreamMicroImage(MicroImageLarge):
+
+    # Initialize StreamMicroImage object
+    # Parameters:
+    # rows, cols: number of rows and columns of the full image
+    def __init__(self, rows, cols):
+        self.rows = rows
+        self.cols = cols
+        self.raw = None # the full raw image never exists
+        self.raw_size = rows * cols # size of the equivalent 8-bit raw image
+        self.rows_so_far = 0
+        self.num_pos_pix = 0 # running number of positive pixels
+        self.stats = {"num_pos_pix": 0, "row_start": 0, "col_start": 0, "row_end": 0, "col_end": 0} # header stats
+        self.processed = None # set by finalize()
+        self._processed_chunks = []
+        self._start_stream()
+
+    # Process the next strip of rows
+    # Parameters:
+    # strip: 2d array of 0 (positive) and 255 (background) pixels, with cols columns
+    # Returns the strip as a binary numpy (1 for positive pixel, 0 for background)
+    def append_rows(self, strip):
+        strip = np.asarray(strip)
+        if self.processed is not None:
+            raise ValueError("Cannot append rows to a finalized image")
+        if strip.ndim != 2 or strip.shape[1] != self.cols:
+            raise ValueError(f"Strip must be a 2d array with {self.cols} columns")
+        if self.rows_so_far + strip.shape[0] > self.rows:
+            raise ValueError(f"Strip goes past the {self.rows} rows of the image")
+        bin_strip = (1 - strip // 255).astype(np.uint8)
+        self._append_bin_rows(bin_strip)
+        self._update_stats(bin_strip)
+        self.rows_so_far += strip.shape[0]
+        return bin_strip
+
+    # Update the running number of positive pixels and bounding box with a strip of rows
+    # Parameters:
+    # bin_strip: binary numpy (1 for positive pixel, 0 for background)
+    def _update_stats(self, bin_strip):
+        pos_rows = np.flatnonzero(bin_strip.any(axis=1))
+        if pos_rows.size == 0:
+            return
+        pos_cols = np.flatnonzero(bin_strip.any(axis=0))
+        if self.num_pos_pix == 0:
+            self.stats.update(row_start=self.rows_so_far + int(pos_rows[0]), col_start=int(pos_cols[0]),
+                              col_end=int(pos_cols[-1]) + 1)
+        self.stats.update(row_end=self.rows_so_far + int(pos_rows[-1]) + 1,
+                          col_start=min(self.stats["col_start"], int(pos_cols[0])),
+                          col_end=max(self.stats["col_end"], int(pos_cols[-1]) + 1))
+        self.num_pos_pix += int(bin_strip.sum())
+        self.stats["num_pos_pix"] = self.num_pos_pix
+
+    # Wrap up the processing once all the rows have been appended
+    # Returns the processed image
+    def finalize(self):
+        if self.rows_so_far != self.rows:
+            raise ValueError(f"Only {self.rows_so_far} of the {self.rows} rows have been appended")
+        if self.processed is None:
+            self._end_stream()
+            res = np.concatenate([np.zeros(0, dtype=self.dtype)] + self._processed_chunks).astype(self.dtype)
+            self.processed = np.concatenate((self._make_header(self.rows, self.cols, self.stats, res.size), res))
+            self._processed_chunks = []
+        return self.processed
+
+    # Set up the processing state (the header is packed by finalize, once the stats are known)
+    def _start_stream(self):
+        raise NotImplementedError
+
+    # Process a strip of rows given as a binary numpy
+    # Parameters:
+    # bin_strip: binary numpy (1 for positive pixel, 0 for background)
+    def _append_bin_rows(self, bin_strip):
+        raise NotImplementedError
+
+    # Process whatever is pending once all the rows have been appended
+    def _end_stream(self):
+        raise NotImplementedError
+
+'''
+ScanLinesStreamMicroImage class incrementally produces the same processed image as ScanLinesMicroImage
+'''
+class ScanLinesStreamMicroImage(StreamMicroImage, ScanLinesMicroImage):
+
+    def __init__(self, rows, cols):
+        super().__init__(rows, cols)
+
+    # Set up the processing state
+    def _start_stream(self):
+        self._last_val = 0 # value of the last pixel processed, the image starts off as background
+        self._last_switch = None # pixel index of the last value switch
+
+    # Record the number of pixels between the value switches found in this strip
+    def _append_bin_rows(self, bin_strip):
+        flat = bin_strip.reshape(-1)
+        if flat.size == 0:
+            return
+        first_pix = self.rows_so_far * self.cols
+        switches = np.flatnonzero(flat != np.concatenate(([self._last_val], flat[:-1]))) + first_pix
+        self._last_val = flat[-1]
+        if switches.size == 0:
+            return
+        if self._last_switch is None: # On first entry, store rows and cols instead of num pixels
+            r, c = self._pix_to_rc(switches[0], self.cols)
+            self._processed_chunks.append(np.array(self._make_shape_repr(r, c), dtype=self.dtype))
+            self._last_switch = switches[0]
+            switches = switches[1:]
+        gaps = np.diff(np.concatenate(([self._last_switch], switches)))
+        self._processed_chunks.append(self._encode_gaps(gaps))
+        if switches.size:
+            self._last_switch = switches[-1]
+
+    # Flag the dtype max outs between the last switch and the end of the image, and like _process, close the last run
+    # at the end of the image if it reaches the last pixel
+    def _end_stream(self):
+        if self._last_switch is None:
+            return
+        if self._last_val:
+            self._processed_chunks.append(self._encode_gaps(np.array([self.rows * self.cols - self._last_switch])))
+        else:
+            num_flags = (self.rows * self.cols - 1 - self._last_switch) // np.iinfo(self.dtype).max
+            self._processed_chunks.append(np.zeros(num_flags, dtype=self.dtype))
+
+'''
+BitMapStreamMicroImage class incrementally produces the same processed image as BitMapMicroImage
+'''
+class BitMapStreamMicroImage(StreamMicroImage, BitMapMicroImage):
+
+    def __init__(self, rows, cols):
+        super().__init__(rows, cols)
+
+    # Set up the processing state
+    def _start_stream(self):
+        self._leftover_bits = np.zeros(0, dtype=np.uint8) # bits that didn't fill a packet of 8 pixels yet
+
+    # Pack every complete packet of 8 pixels, keeping the rest for the next strip
+    def _append_bin_rows(self, bin_strip):
+        bits = np.concatenate((self._leftover_bits, bin_strip.reshape(-1)))
+        num_packed = bits.size - bits.size % 8
+        self._processed_chunks.append(np.packbits(bits[:num_packed]))
+        self._leftover_bits = bits[num_packed:]
+
+    # Like _process, an incomplete packet of 8 pixels at the end of the image is dropped
+    def _end_stream(self):
+        self._leftover_bits = np.zeros(0, dtype=np.uint8)
+
+# Auxiliary class to show how this framework can be extended. To ship processed images between processes or machines,
+# use the binary frames of transport.py instead
 class Base64MicroImage(MicroImageLarge):
 
     def __init__(self, path):
@@ -304,6 +1676,7 @@ class Base64MicroImage(MicroImageLarge):
         return base64.b64encode(buffer.getvalue())
 
     def _inverse_process(self, processed_img):
+        from PIL import Image
         img_bytes = base64.b64decode(processed_img)
         buf = BytesIO(img_bytes)
         img = Image.open(buf)
@@ -320,9 +1693,14 @@ class Base64MicroImage(MicroImageLarge):
         print("")
 
         print("---PROCESSED---")
-        print(f"total size of processed data (bytes): {getsizeof(self.processed)}")
-        print(f"Percentage of original size (%): {getsizeof(self.processed) / self.raw_size}")
+        print(f"total size of processed data (bytes): {len(self.processed)}")
+        if self.raw_size is not None: # no raw image when made from a processed image, e.g. by erode or dilate
+            print(f"Percentage of original size (%): {len(self.processed) / self.raw_size}")
         print("")
 
     def calc_veins_perc(self, veins_of_this_body):
         return NotImplementedError
+
+# MicroImage processing techniques that can be asked for by name (e.g. in work queue jobs or analysis service requests)
+CODECS = {MicroImageClass.name: MicroImageClass
+          for MicroImageClass in (ScanLinesMicroImage, BitMapMicroImage, VerticalDeltaMicroImage, SparseMicroImage)}
@@ -1,9 +1,7 @@
-from micro_image_large import ScanLinesMicroImage, BitMapMicroImage
+from micro_image_large import RunsMicroImage, ScanLinesMicroImage, BitMapMicroImage, SparseMicroImage
 import config as cfg
-import matplotlib.pyplot as plt
 import numpy as np
 import os
-from PIL import Image
 import sys
 
 
@@ -18,24 +16,104 @@ class Parasite():
     # body_img_path: the path to the body image file
     # veins_img_path: the path to the veins image file
     # MicroImageClass: the MicroImage processing technique to use. I implemented 2: ScanLinesMicroImage, BitMapMicroImage
-    def __init__(self, sess_name, body_img_path, veins_img_path, MicroImageClass):
+    # mode: "exact" computes the veins-to-body fraction, "early_exit" only classifies the parasite and stops scanning
+    #       as soon as the result is determined (veins_body_frac is then None), "approx" estimates the fraction from
+    #       a sample of body pixels and only computes it exactly when the estimate is too close to the threshold
+    # VeinsMicroImageClass: the MicroImage processing technique to use for the veins, if different from the body's.
+    #                       Only SparseMicroImage can be used with any body, see check_codecs
+    def __init__(self, sess_name, body_img_path, veins_img_path, MicroImageClass, mode="exact",
+                 VeinsMicroImageClass=None):
+        self.check_codecs(MicroImageClass, VeinsMicroImageClass)
+        self.body_img_path = body_img_path
+        self.veins_img_path = veins_img_path
+        self._set_micro_images(sess_name, MicroImageClass(body_img_path),
+                               (VeinsMicroImageClass or MicroImageClass)(veins_img_path), mode)
+
+    # Create a Parasite from already processed body and veins MicroImage objects (e.g. made with from_processed)
+    # Parameters:
+    # sess_name: Name of the session for file-saving purposes
+    # body, veins: the MicroImage objects of the body and veins images
+    # mode: see __init__
+    @classmethod
+    def from_micro_images(cls, sess_name, body, veins, mode="exact"):
+        cls.check_codecs(type(body), type(veins))
+        par = cls.__new__(cls)
+        par.body_img_path = None
+        par.veins_img_path = None
+        par._set_micro_images(sess_name, body, veins, mode)
+        return par
+
+    # Check that body and veins images processed with these MicroImage processing techniques can be analysed together.
+    # The analysis overlaps the processed body and veins, so the veins must be processed like the body, except for
+    # SparseMicroImage veins, that only look up their vein pixels in the body (see SparseMicroImage.calc_perc_of_body)
+    # Parameters:
+    # MicroImageClass, VeinsMicroImageClass: see __init__
+    @staticmethod
+    def check_codecs(MicroImageClass, VeinsMicroImageClass=None):
+        if VeinsMicroImageClass not in (None, MicroImageClass, SparseMicroImage):
+            raise ValueError(f"{VeinsMicroImageClass.__name__} veins can't be analysed with a {MicroImageClass.__name__} "
+                             f"body, use {MicroImageClass.__name__} or SparseMicroImage veins")
+
+    # Set the processed images and analyse them
+    def _set_micro_images(self, sess_name, body, veins, mode):
         self.sess_name = sess_name
-        self.mic_name = MicroImageClass.name
-        self.body = MicroImageClass(body_img_path)
-        self.veins = MicroImageClass(veins_img_path)
+        self.mic_name = body.name
+        self.mode = mode
+        self.body = body
+        self.veins = veins
+        self.cancer_flag = None # set directly by the modes that classify without computing the exact fraction
+        self.veins_body_frac_bounds = None # confidence interval of veins_body_frac, set by the "approx" mode
+        self.saved_filenames = {} # "body" / "veins" -> filename with which save_data saved its processed image
         self.veins_body_frac = self.calc_cancer()
 
     # Calculate the percentage of veins pixels within the body out of the whole body using the passed in 
     # MicroImage technique
     def calc_cancer(self):
+        if self.mode == "exact":
+            return self._calc_exact_veins_perc()
+        elif self.mode == "early_exit":
+            if isinstance(self.veins, SparseMicroImage): # only visits the vein pixels, nothing to stop early
+                self.cancer_flag = self.veins.calc_perc_of_body(self.body) > cfg.CANCER_THRESH_PERC
+            else:
+                self.cancer_flag = self.body.classify_veins_perc(self.veins, cfg.CANCER_THRESH_PERC)
+            return None
+        elif self.mode == "approx":
+            estimate, low, high = self.body.estimate_veins_perc(self.veins)
+            if low <= cfg.CANCER_THRESH_PERC < high: # borderline case, the estimate can't decide
+                estimate = self._calc_exact_veins_perc()
+                low, high = estimate, estimate
+            self.veins_body_frac_bounds = (low, high)
+            return estimate
+        raise ValueError(f"Unknown analysis mode: {self.mode}")
+
+    # Calculate the exact percentage of veins pixels within the body out of the whole body
+    def _calc_exact_veins_perc(self):
+        if isinstance(self.veins, SparseMicroImage): # only visit the vein pixels
+            return self.veins.calc_perc_of_body(self.body)
         return self.body.calc_veins_perc(self.veins)
 
     # Determine whether the veins-to-body percentage is > than the cancer threshold (in our case 10%)
     def has_cancer(self):
+        if self.cancer_flag is not None:
+            return self.cancer_flag
         return self.veins_body_frac > cfg.CANCER_THRESH_PERC
 
+    # Per-region detail: the connected body fragments with their area, bounding box and vein density, and the connected
+    # vein clusters with their area and bounding box. See RunsMicroImage.label_components
+    # Parameters:
+    # connectivity: 4 or 8
+    # Returns the tables of body and veins components
+    def calc_components(self, connectivity=8):
+        for micro_image in (self.body, self.veins):
+            if not isinstance(micro_image, RunsMicroImage):
+                raise ValueError(f"Connected components are not implemented for {micro_image.name}")
+        return (self.body.label_components(self.veins, connectivity=connectivity),
+                self.veins.label_components(connectivity=connectivity))
+
     # Show a superimposed image of the loaded in body and veins image, using a 50% blend alpha
     def show_image(self):
+        import matplotlib.pyplot as plt
+        from PIL import Image
         plt.imshow(Image.blend(self.body.raw, self.veins.raw, 0.5), cmap='gray')
         plt.show()
 
@@ -43,19 +121,102 @@ class Parasite():
     def save_body_data(self):
         print("BODY DATA :")
         self.body.print_memory()
-        self.body.save_processed_img(self.sess_name + "_body_" + self.mic_name)
+        self.body.save_processed_img(self.processed_filename("body"))
+        self.saved_filenames["body"] = self.processed_filename("body")
 
     # Save processed veins data as a compressed numpy. Also print out compression rate
     def show_veins_data(self):
         print("VEINS DATA :")
         self.veins.print_memory()
-        self.veins.save_processed_img(self.sess_name + "_veins_" + self.mic_name)
+        self.veins.save_processed_img(self.processed_filename("veins"))
+        self.saved_filenames["veins"] = self.processed_filename("veins")
+
+    # filename (without extension) with which the processed body or veins image is saved
+    # Parameters:
+    # kind: "body" or "veins"
+    def processed_filename(self, kind):
+        micro_image = self.body if kind == "body" else self.veins
+        return self.sess_name + "_" + kind + "_" + micro_image.name
 
     # Save all the compressed data
     def save_data(self):
         self.save_body_data()
         self.show_veins_data()
 
+'''
+Class to process body and veins images of a parasite as they arrive from the microscope as successive strips of rows.
+Running totals of body pixels and vein-in-body pixels are kept, so the analysis is ready as soon as the last strip is in.
+'''
+class ParasiteStream(Parasite):
+
+    # Initialize ParasiteStream object
+    # Parameters:
+    # sess_name: Name of the session for file-saving purposes
+    # rows, cols: number of rows and columns of the body and veins images
+    # StreamMicroImageClass: the StreamMicroImage processing technique to use: ScanLinesStreamMicroImage,
+    #                        BitMapStreamMicroImage
+    def __init__(self, sess_name, rows, cols, StreamMicroImageClass):
+        self.sess_name = sess_name
+        self.mic_name = StreamMicroImageClass.name
+        self.mode = "stream"
+        self.body_img_path = None # the images never exist as files
+        self.veins_img_path = None
+        self.body = StreamMicroImageClass(rows, cols)
+        self.veins = StreamMicroImageClass(rows, cols)
+        self.cancer_flag = None
+        self.veins_body_frac_bounds = None
+        self.saved_filenames = {}
+        self.num_body_pix = 0 # running number of body pixels
+        self.valid_vein = 0 # running number of vein pixels within the body
+        self.veins_body_frac = None # set by finalize()
+
+    # Process the next strip of rows of both images
+    # Parameters:
+    # body_strip, veins_strip: matching strips of rows of the body and veins images (0 positive, 255 background)
+    def append_rows(self, body_strip, veins_strip):
+        body_strip, veins_strip = np.asarray(body_strip), np.asarray(veins_strip)
+        if body_strip.shape != veins_strip.shape: # checked before either image or the running totals are updated
+            raise ValueError(f"Body strip of shape {body_strip.shape} and veins strip of shape {veins_strip.shape} "
+                             "don't match")
+        bin_body = self.body.append_rows(body_strip)
+        bin_veins = self.veins.append_rows(veins_strip)
+        self.num_body_pix += int(bin_body.sum())
+        self.valid_vein += int((bin_body & bin_veins).sum())
+
+    # Wrap up the processing of both images once all the rows have been appended, and compute the veins-to-body
+    # fraction from the running totals
+    def finalize(self):
+        self.body.finalize()
+        self.veins.finalize()
+        self.veins_body_frac = self.calc_cancer()
+        return self.veins_body_frac
+
+    # Calculate the percentage of veins pixels within the body out of the whole body from the running totals
+    def calc_cancer(self):
+        return self.valid_vein / self.num_body_pix
+
+    # Determine whether the veins-to-body percentage is > than the cancer threshold, once all the rows are in
+    def has_cancer(self):
+        self._check_finalized()
+        return super().has_cancer()
+
+    # Show a superimposed image of the body and veins, like Parasite.show_image. The raw images never exist, so they
+    # are decoded from the processed images once all the rows are in
+    def show_image(self):
+        import matplotlib.pyplot as plt
+        from PIL import Image
+        self._check_finalized()
+        body, veins = [micro_image._bin_npy_to_raw(micro_image.decode_into(np.zeros((micro_image.rows, micro_image.cols),
+                                                                                    dtype=np.uint8)))
+                       for micro_image in (self.body, self.veins)]
+        plt.imshow(Image.blend(body, veins, 0.5), cmap='gray')
+        plt.show()
+
+    # Raise a ValueError until finalize() has been called
+    def _check_finalized(self):
+        if self.veins_body_frac is None:
+            raise ValueError("Stream not finalized: call finalize() once all the rows have been appended")
+
 if __name__=="__main__":
     
     par1 = Parasite("lab0",
@@ -0,0 +1,155 @@
+from micro_image_large import MicroImageLarge, ScanLinesMicroImage, BitMapMicroImage
+import config as cfg
+import numpy as np
+
+
+'''
+Class to analyse many parasites at once. The processed body and veins images of all the parasites are concatenated
+into contiguous arrays with offset tables, so that the veins-to-body fractions of all of them are computed with a
+handful of NumPy operations instead of one Python call per parasite.
+'''
+class ParasiteBatch():
+
+    # Lookup table of the number of set bits of every byte value
+    popcount_table = np.array([bin(b).count("1") for b in range(256)], dtype=np.int64)
+
+    # Initialize ParasiteBatch object
+    # Parameters:
+    # processed_pairs: list of (processed body image, processed veins image) pairs, the results of _process()
+    # MicroImageClass: the MicroImage processing technique of all the processed images: ScanLinesMicroImage or
+    #                  BitMapMicroImage
+    def __init__(self, processed_pairs, MicroImageClass):
+        if MicroImageClass not in (ScanLinesMicroImage, BitMapMicroImage):
+            raise ValueError(f"Batch analysis is not implemented for {MicroImageClass.name}")
+        self.mic_name = MicroImageClass.name
+        self.dtype = MicroImageClass.dtype
+        self.bodies = [np.asarray(body, dtype=self.dtype) for body, veins in processed_pairs]
+        self.veins = [np.asarray(veins, dtype=self.dtype) for body, veins in processed_pairs]
+        self.veins_body_frac = self.calc_cancer()
+
+    # Create a ParasiteBatch from already processed Parasite objects (all using the same MicroImage technique)
+    # Parameters:
+    # parasites: list of Parasite objects
+    @classmethod
+    def from_parasites(cls, parasites):
+        return cls([(par.body.processed, par.veins.processed) for par in parasites], type(parasites[0].body))
+
+    # Create a ParasiteBatch from processed images saved with save_processed_img
+    # Parameters:
+    # path_pairs: list of (path to saved body, path to saved veins) pairs
+    # MicroImageClass: the MicroImage processing technique of all the saved images
+    @classmethod
+    def from_saved(cls, path_pairs, MicroImageClass):
+        return cls([(np.load(body_path), np.load(veins_path)) for body_path, veins_path in path_pairs], MicroImageClass)
+
+    # Calculate the percentage of veins pixels within the body out of the whole body of every parasite
+    def calc_cancer(self):
+        if len(self.bodies) == 0:
+            return np.zeros(0)
+        body_headers = self._ret_headers(self.bodies)
+        veins_headers = self._ret_headers(self.veins)
+        if not (np.array_equal(body_headers["rows"], veins_headers["rows"]) and
+                np.array_equal(body_headers["cols"], veins_headers["cols"])):
+            raise ValueError("Body and veins images of a parasite must have the same size")
+        if self.mic_name == ScanLinesMicroImage.name:
+            valid_vein = self._calc_scanlines_valid_vein(body_headers, veins_headers)
+        else:
+            valid_vein = self._calc_bitmap_valid_vein(body_headers)
+        return valid_vein / body_headers["num_pos_pix"]
+
+    # Determine whether the veins-to-body percentage of every parasite is > than the cancer threshold
+    def has_cancer(self):
+        return self.veins_body_frac > cfg.CANCER_THRESH_PERC
+
+    # Concatenate processed images and unpack all of their headers at once
+    # Parameters:
+    # processed_imgs: list of processed images
+    # Returns a dict of arrays: the header_dtype fields, the concatenated images ("flat"), and the index of the first
+    # element ("offset") and of the first data element ("data_start") of every image in the concatenated array
+    def _ret_headers(self, processed_imgs):
+        sizes = np.array([img.size for img in processed_imgs], dtype=np.int64)
+        flat = np.concatenate(processed_imgs)
+        offsets = np.cumsum(sizes) - sizes
+        header_len = MicroImageLarge.header_dtype.itemsize // flat.itemsize
+        if (sizes < 1 + header_len).any():
+            raise ValueError("Processed image is too short to hold a header")
+        header_elements = flat[offsets[:, None] + 1 + np.arange(header_len)]
+        header_bytes = header_elements.astype(flat.dtype.newbyteorder("<")).tobytes()
+        records = np.frombuffer(header_bytes, dtype=MicroImageLarge.header_dtype)
+        headers = {name: records[name].astype(np.int64) for name in MicroImageLarge.header_dtype.names}
+        if not np.array_equal(headers["num_elements"], sizes - 1 - header_len): # see MicroImageLarge._ret_header_fields
+            raise ValueError("Processed image header doesn't match the size of the processed image")
+        headers.update(flat=flat, offset=offsets, data_start=offsets + 1 + header_len, size=sizes)
+        return headers
+
+    # Number of vein pixels within the body of every parasite, for BitMap processed images: the bytes of all bodies and
+    # all veins are ANDed and their set bits counted in one go
+    # Parameters:
+    # body_headers: result of _ret_headers for the bodies
+    def _calc_bitmap_valid_vein(self, body_headers):
+        veins_flat = np.concatenate(self.veins)
+        if veins_flat.size != body_headers["flat"].size:
+            raise ValueError("Body and veins images of a parasite must have the same size")
+        item = np.repeat(np.arange(len(self.bodies)), body_headers["size"])
+        is_data = np.arange(item.size) >= body_headers["data_start"][item]
+        overlap = self.popcount_table[(body_headers["flat"] & veins_flat)[is_data]]
+        return np.bincount(item[is_data], weights=overlap, minlength=len(self.bodies))
+
+    # Number of vein pixels within the body of every parasite, for ScanLines processed images: the runs of all images
+    # are laid end to end (every image is offset by the number of pixels of the images before it), and the body runs
+    # are overlapped with the veins runs in one go
+    # Parameters:
+    # body_headers, veins_headers: results of _ret_headers for the bodies and the veins
+    def _calc_scanlines_valid_vein(self, body_headers, veins_headers):
+        frame_sizes = body_headers["rows"] * body_headers["cols"]
+        frame_offsets = np.cumsum(frame_sizes) - frame_sizes
+        body_starts, body_ends = self._ret_scanlines_runs(body_headers, frame_offsets)
+        veins_starts, veins_ends = self._ret_scanlines_runs(veins_headers, frame_offsets)
+        count_before = MicroImageLarge._count_run_pix_before
+        valid_vein = count_before(veins_starts, veins_ends, body_ends) - \
+            count_before(veins_starts, veins_ends, body_starts)
+        item = np.searchsorted(frame_offsets, body_starts, side="right") - 1
+        return np.bincount(item, weights=valid_vein, minlength=len(self.bodies))
+
+    # Vectorized version of ScanLinesMicroImage._ret_runs over all the concatenated images
+    # Parameters:
+    # headers: result of _ret_headers
+    # frame_offsets: number of pixels to offset the runs of every image by
+    def _ret_scanlines_runs(self, headers, frame_offsets):
+        flat, data_start = headers["flat"].astype(np.int64), headers["data_start"]
+        num_items = data_start.size
+        has_data = headers["num_elements"] > 0
+        # unpack the rows and cols of the first positive pixel (see _make_shape_repr) of every image
+        num_row_digits = np.where(has_data, flat[np.minimum(data_start, flat.size - 1)], 0)
+        num_col_digits = np.where(has_data, flat[np.minimum(data_start + 1, flat.size - 1)], 0)
+        first_row, first_col = np.zeros(num_items, dtype=np.int64), np.zeros(num_items, dtype=np.int64)
+        for k in range(int(max(num_row_digits.max(), num_col_digits.max()))):
+            row_digit = flat[np.minimum(data_start + 2 + k, flat.size - 1)]
+            col_digit = flat[np.minimum(data_start + 2 + num_row_digits + k, flat.size - 1)]
+            first_row = np.where(k < num_row_digits, first_row * 10 + row_digit, first_row)
+            first_col = np.where(k < num_col_digits, first_col * 10 + col_digit, first_col)
+        first_pix = frame_offsets + first_row * headers["cols"] + first_col
+        # walk the brush switches of all images at once
+        item = np.repeat(np.arange(num_items), headers["size"])
+        switch_start = data_start + 2 + num_row_digits + num_col_digits
+        is_switch_region = has_data[item] & (np.arange(flat.size) >= switch_start[item])
+        brush_switches, item = flat[is_switch_region], item[is_switch_region]
+        steps = np.where(brush_switches != 0, brush_switches, np.iinfo(self.dtype).max)
+        steps_so_far = np.cumsum(steps)
+        item_first = np.searchsorted(item, np.arange(num_items))
+        item_base = np.concatenate((steps_so_far - steps, [0]))[item_first]
+        pix_so_far = first_pix[item] + steps_so_far - item_base[item]
+        # run bounds of every image: its first positive pixel then its switches, closed at its last max out if needed
+        is_switch = brush_switches != 0
+        bounds = np.concatenate((first_pix[has_data], pix_so_far[is_switch]))
+        bounds_item = np.concatenate((np.flatnonzero(has_data), item[is_switch]))
+        num_bounds = np.bincount(bounds_item, minlength=num_items)
+        item_last = np.searchsorted(item, np.arange(num_items), side="right") - 1
+        last_pix = np.where(item_last >= item_first, pix_so_far[np.maximum(item_last, 0)] if item.size else 0, first_pix)
+        unclosed = np.flatnonzero(num_bounds % 2 == 1)
+        bounds = np.concatenate((bounds, last_pix[unclosed]))
+        bounds_item = np.concatenate((bounds_item, unclosed))
+        bounds = bounds[np.argsort(bounds_item, kind="stable")]
+        starts, ends = bounds[0::2], bounds[1::2]
+        non_empty = ends > starts
+        return starts[non_empty], ends[non_empty]
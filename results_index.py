@@ -0,0 +1,198 @@
+from parasite import Parasite
+import config as cfg
+import hashlib
+import numpy as np
+import os
+import sqlite3
+import time
+
+
+'''
+ResultsIndex class keeps a local SQLite index of the processed parasites: per session and image, the codecs of the body
+and veins, the analysis mode, where the processed image was saved, its size and header stats, the veins-to-body fraction,
+the cancer flag and the content hash of the input image files. Parasites already indexed with the same codecs and mode
+are never processed again.
+'''
+class ResultsIndex():
+
+    # One row per processed parasite
+    PARASITES_SCHEMA = """
+        CREATE TABLE IF NOT EXISTS parasites (
+            id INTEGER PRIMARY KEY,
+            sess_name TEXT NOT NULL,
+            codec TEXT NOT NULL,
+            veins_codec TEXT NOT NULL,
+            mode TEXT NOT NULL,
+            body_hash TEXT NOT NULL,
+            veins_hash TEXT NOT NULL,
+            rows INTEGER,
+            cols INTEGER,
+            num_body_pix INTEGER,
+            veins_body_frac REAL,
+            has_cancer INTEGER NOT NULL,
+            created_at REAL NOT NULL,
+            UNIQUE (body_hash, veins_hash, codec, veins_codec, mode)
+        )"""
+    # One row per processed image (body and veins) of a parasite
+    IMAGES_SCHEMA = """
+        CREATE TABLE IF NOT EXISTS images (
+            id INTEGER PRIMARY KEY,
+            parasite_id INTEGER NOT NULL REFERENCES parasites (id),
+            kind TEXT NOT NULL,
+            codec TEXT NOT NULL,
+            input_path TEXT,
+            input_hash TEXT NOT NULL,
+            payload_path TEXT,
+            payload_offset INTEGER,
+            payload_nbytes INTEGER,
+            rows INTEGER,
+            cols INTEGER,
+            num_pos_pix INTEGER
+        )"""
+    INDEXES = [
+        "CREATE INDEX IF NOT EXISTS parasites_created_at ON parasites (created_at)",
+        "CREATE INDEX IF NOT EXISTS parasites_sess_name ON parasites (sess_name)",
+        "CREATE INDEX IF NOT EXISTS images_parasite_id ON images (parasite_id)",
+    ]
+
+    # Initialize ResultsIndex object, creating the database if needed
+    # Parameters:
+    # db_path: path to the SQLite database file
+    def __init__(self, db_path=cfg.RESULTS_INDEX_PATH):
+        self.db_path = db_path
+        self.conn = sqlite3.connect(db_path)
+        self.conn.row_factory = sqlite3.Row
+        with self.conn:
+            self.conn.execute(self.PARASITES_SCHEMA)
+            self.conn.execute(self.IMAGES_SCHEMA)
+            for index in self.INDEXES:
+                self.conn.execute(index)
+
+    # Close the connection to the database
+    def close(self):
+        self.conn.close()
+
+    # Compute the content hash of an input image file, reading it in chunks
+    # Parameters:
+    # path: path to the image file
+    @staticmethod
+    def hash_file(path):
+        digest = hashlib.sha256()
+        with open(path, "rb") as infile:
+            for chunk in iter(lambda: infile.read(cfg.RESULTS_INDEX_HASH_CHUNK), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    # Look up an already indexed parasite from the content of its input images
+    # Parameters:
+    # body_img_path, veins_img_path: paths to the body and veins image files
+    # codec: name of the MicroImage processing technique (e.g. "scanlines")
+    # veins_codec: name of the MicroImage processing technique of the veins, the body's if None
+    # mode: the analysis mode, see Parasite
+    # Returns the parasites row as a dict, or None if the parasite was never indexed with these codecs and mode
+    def lookup(self, body_img_path, veins_img_path, codec, veins_codec=None, mode="exact"):
+        return self._lookup_hashes(self.hash_file(body_img_path), self.hash_file(veins_img_path), codec,
+                                   veins_codec or codec, mode)
+
+    # Look up an already indexed parasite from the content hashes of its input images
+    def _lookup_hashes(self, body_hash, veins_hash, codec, veins_codec, mode):
+        row = self.conn.execute("SELECT * FROM parasites WHERE body_hash = ? AND veins_hash = ? AND codec = ? AND "
+                                "veins_codec = ? AND mode = ?", (body_hash, veins_hash, codec, veins_codec, mode)
+                                ).fetchone()
+        return dict(row) if row is not None else None
+
+    # Record a processed parasite in the index. The location of a processed image is only recorded if it was saved by
+    # this Parasite (see Parasite.save_data), it is recorded without a payload path otherwise
+    # Parameters:
+    # par: the Parasite object
+    # body_hash, veins_hash: content hashes of the input images, computed from the Parasite's image paths if not given.
+    # They must be given for a Parasite without input image files (e.g. a ParasiteStream or made from processed images)
+    # Returns the id of the parasites row
+    def add_parasite(self, par, body_hash=None, veins_hash=None):
+        for kind, img_hash, img_path in (("body", body_hash, par.body_img_path),
+                                         ("veins", veins_hash, par.veins_img_path)):
+            if img_hash is None and img_path is None:
+                raise ValueError(f"Parasite {par.sess_name} has no {kind} image file to hash, pass its {kind}_hash "
+                                 f"to index it")
+        body_hash = body_hash or self.hash_file(par.body_img_path)
+        veins_hash = veins_hash or self.hash_file(par.veins_img_path)
+        body_header = par.body.read_header()
+        indexed = self._lookup_hashes(body_hash, veins_hash, par.mic_name, par.veins.name, par.mode)
+        with self.conn:
+            if indexed is not None: # replace the previous results of the same input images
+                self.conn.execute("DELETE FROM images WHERE parasite_id = ?", (indexed["id"],))
+                self.conn.execute("DELETE FROM parasites WHERE id = ?", (indexed["id"],))
+            cursor = self.conn.execute(
+                "INSERT INTO parasites (sess_name, codec, veins_codec, mode, body_hash, veins_hash, rows, cols, "
+                "num_body_pix, veins_body_frac, has_cancer, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (par.sess_name, par.mic_name, par.veins.name, par.mode, body_hash, veins_hash, body_header["rows"],
+                 body_header["cols"], body_header["num_pos_pix"], par.veins_body_frac, int(par.has_cancer()),
+                 time.time()))
+            parasite_id = cursor.lastrowid
+            for kind, micro_image, input_path, input_hash in (("body", par.body, par.body_img_path, body_hash),
+                                                              ("veins", par.veins, par.veins_img_path, veins_hash)):
+                header = micro_image.read_header()
+                payload_path, payload_offset, payload_nbytes = self._ret_payload_location(par.saved_filenames.get(kind))
+                self.conn.execute(
+                    "INSERT INTO images (parasite_id, kind, codec, input_path, input_hash, payload_path, "
+                    "payload_offset, payload_nbytes, rows, cols, num_pos_pix) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (parasite_id, kind, micro_image.name, input_path, input_hash, payload_path, payload_offset,
+                     payload_nbytes, header["rows"], header["cols"], header["num_pos_pix"]))
+        return parasite_id
+
+    # Find where the payload of a saved processed image is within its .npy file
+    # Parameters:
+    # filename: the filename with which the processed image was saved, None if it wasn't
+    # Returns the path, byte offset and number of bytes of the payload, all None if it wasn't saved
+    def _ret_payload_location(self, filename):
+        if filename is None:
+            return None, None, None
+        path = os.path.join(cfg.PROCESSED_DIR, f"{filename}.npy")
+        if not os.path.exists(path): # e.g. saved in another format than .npy
+            return None, None, None
+        payload = np.load(path, mmap_mode="r")
+        return path, int(payload.offset), int(payload.nbytes)
+
+    # Process, save and index a parasite, unless its input images were already indexed with these codecs and mode
+    # Parameters:
+    # sess_name, body_img_path, veins_img_path, MicroImageClass, mode, VeinsMicroImageClass: see Parasite
+    # Returns the parasites row as a dict
+    def process_parasite(self, sess_name, body_img_path, veins_img_path, MicroImageClass, mode="exact",
+                         VeinsMicroImageClass=None):
+        Parasite.check_codecs(MicroImageClass, VeinsMicroImageClass) # before hashing the input images
+        body_hash, veins_hash = self.hash_file(body_img_path), self.hash_file(veins_img_path)
+        key = (body_hash, veins_hash, MicroImageClass.name, (VeinsMicroImageClass or MicroImageClass).name, mode)
+        indexed = self._lookup_hashes(*key)
+        if indexed is not None:
+            return indexed
+        par = Parasite(sess_name, body_img_path, veins_img_path, MicroImageClass, mode, VeinsMicroImageClass)
+        par.save_data()
+        self.add_parasite(par, body_hash, veins_hash)
+        return self._lookup_hashes(*key)
+
+    # Query the indexed parasites
+    # Parameters:
+    # has_cancer: only return the parasites with (True) or without (False) cancer
+    # since: only return the parasites indexed after this unix time (e.g. time.time() - 7 * 24 * 3600 for last week)
+    # sess_name: only return the parasites of this session
+    # codec: only return the parasites processed with this MicroImage processing technique
+    # mode: only return the parasites analysed in this mode (see Parasite)
+    # Returns a list of parasites rows as dicts, most recent first
+    def query(self, has_cancer=None, since=None, sess_name=None, codec=None, mode=None):
+        conditions, params = [], []
+        for column, op, value in (("has_cancer", "=", None if has_cancer is None else int(has_cancer)),
+                                  ("created_at", ">=", since), ("sess_name", "=", sess_name), ("codec", "=", codec),
+                                  ("mode", "=", mode)):
+            if value is not None:
+                conditions.append(f"{column} {op} ?")
+                params.append(value)
+        where = " WHERE " + " AND ".join(conditions) if conditions else ""
+        rows = self.conn.execute(f"SELECT * FROM parasites{where} ORDER BY created_at DESC", params).fetchall()
+        return [dict(row) for row in rows]
+
+    # Get the indexed images (body and veins) of a parasite
+    # Parameters:
+    # parasite_id: id of the parasites row
+    def images(self, parasite_id):
+        rows = self.conn.execute("SELECT * FROM images WHERE parasite_id = ? ORDER BY kind", (parasite_id,)).fetchall()
+        return [dict(row) for row in rows]
@@ -1,11 +1,9 @@
 import config as cfg
-import matplotlib.pyplot as plt
 import numpy as np
-from PIL import Image
 from random import randint, choice
-from skimage.transform import resize
 import os
 import sys
+# matplotlib, Pillow and scikit-image are imported on first use, so that importing this module stays cheap
 
 sys.setrecursionlimit(10**6)
 
@@ -34,6 +32,7 @@ class Simulator():
 
     # Show superimposed images of body-vein pairs
     def show_everything(self):
+        import matplotlib.pyplot as plt
         for bd, vs in zip(self.bodies, self.veins):
             plt.imshow(255-np.minimum(bd//5 + vs//3, 255), cmap='gray')
             plt.show()
@@ -45,12 +44,14 @@ class Simulator():
 
     # Show all the rendered images of parasite bodies
     def show_all_bodies(self):
+        import matplotlib.pyplot as plt
         for img in self.bodies:
             plt.imshow(255-img, cmap='gray')
             plt.show()
 
     # # Show all the rendered images of parasite veins
     def show_all_veins(self):
+        import matplotlib.pyplot as plt
         for vs in self.veins:
             plt.imshow(255-vs, cmap='gray')
             plt.show()
@@ -64,6 +65,7 @@ class Simulator():
     # The filename will be {session name}_{sample number}_rf{resize factor}_body.{file type}
     # Resizing happens using interpolation with NEAREST pixel sampling
     def save_all_bodies(self):
+        from PIL import Image
         for rf in self.resize_factors:
             for i, img in enumerate(self.bodies):
                 path = os.path.join(cfg.COLLECTED_DIR, f"{self.sess_name}_{i}_rf{rf}_body.{self.im_save_type}")
@@ -74,6 +76,7 @@ class Simulator():
     # The filename will be {session name}_{sample number}_rf{resize factor}_veins.{file type}
     # Resizing happens using interpolation with NEAREST pixel sampling
     def save_all_veins(self):
+        from PIL import Image
         for rf in self.resize_factors:
             for i, img in enumerate(self.veins):
                 path = os.path.join(cfg.COLLECTED_DIR, f"{self.sess_name}_{i}_rf{rf}_veins.{self.im_save_type}")
@@ -93,6 +96,7 @@ class Simulator():
     # num_runs: number of recursive random brush strokes to run to draw one body image
     # thickness: width of square brush
     def _create_body(self, frame, num_runs=3, thickness=40):
+        from skimage.transform import resize
         outer_frame, inner_frame = frame.frame_to_arrays()
         drawing_canvas = outer_frame.copy()
         mid_pix = self._get_mid_pix(drawing_canvas)
@@ -275,6 +279,7 @@ class Frame():
     # Shows the generated frames on which to draw the parasites. Shows inner frame area as a percentage of 
     # the outer frame area.
     def show_frame(self):
+        import matplotlib.pyplot as plt
         outer_frame, inner_frame = self.frame_to_arrays()
         outer_frame += 1
         comb_frame = self.place_inner_into_outer(outer_frame, inner_frame)
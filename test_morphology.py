@@ -0,0 +1,82 @@
+from micro_image_large import MicroImageLarge, ScanLinesMicroImage, VerticalDeltaMicroImage, SparseMicroImage
+from parasite import Parasite
+import config as cfg
+import numpy as np
+import pytest
+
+
+CODECS = [ScanLinesMicroImage, VerticalDeltaMicroImage, SparseMicroImage]
+SIZES = [(1, 1), (3, 3), (2, 5), (4, 1), (1, 4), (5, 2), (7, 7)]
+
+
+# Build a processed image of the given codec straight from a binary numpy, through its positive runs
+def make_image(MicroImageClass, pixels):
+    flat = np.concatenate(([0], pixels.reshape(-1).astype(np.int8), [0]))
+    switches = np.flatnonzero(np.diff(flat))
+    encoder = MicroImageClass.__new__(MicroImageClass)
+    return MicroImageClass.from_processed(encoder._runs_to_processed(switches[0::2], switches[1::2], *pixels.shape))
+
+
+# Decode a processed image into a binary numpy
+def decode(micro_image):
+    header = micro_image._ret_header_fields(micro_image.processed)
+    return micro_image.decode_into(np.zeros((header["rows"], header["cols"]), dtype=bool))
+
+
+# Brute force erosion or dilation with a height x width rectangle, centered like RunsMicroImage.erode and dilate
+def morph_reference(pixels, height, width, erode):
+    rows, cols = pixels.shape
+    padded = np.zeros((rows + 2 * height, cols + 2 * width), dtype=bool)
+    padded[height:height + rows, width:width + cols] = pixels
+    res = np.full(pixels.shape, erode)
+    before_rows, before_cols = ((height - 1) // 2, (width - 1) // 2) if erode else (height // 2, width // 2)
+    for dy in range(-before_rows, height - before_rows):
+        for dx in range(-before_cols, width - before_cols):
+            shifted = padded[height + dy:height + dy + rows, width + dx:width + dx + cols]
+            res = res & shifted if erode else res | shifted
+    return res
+
+
+def random_images():
+    rng = np.random.default_rng(0)
+    images = [rng.random(rng.integers(5, 40, 2)) < rng.uniform(0.1, 0.9) for trial in range(6)]
+    images.append(np.ones((6, 9), dtype=bool)) # every run reaches the last pixel
+    corner = np.zeros((8, 8), dtype=bool)
+    corner[-2:, -3:] = True # dilations and closings reach the bottom-right corner
+    images.append(corner)
+    wide = np.zeros((3, 40000), dtype=bool) # gaps longer than the ScanLines dtype
+    wide[0, 5:9], wide[2, -4:] = True, True
+    images.append(wide)
+    return images
+
+
+@pytest.mark.parametrize("MicroImageClass", CODECS)
+@pytest.mark.parametrize("image_idx", range(len(random_images())))
+def test_morph_matches_reference(MicroImageClass, image_idx):
+    pixels = random_images()[image_idx]
+    micro_image = make_image(MicroImageClass, pixels)
+    assert np.array_equal(decode(micro_image), pixels)
+    for height, width in SIZES:
+        eroded = morph_reference(pixels, height, width, True)
+        dilated = morph_reference(pixels, height, width, False)
+        expected = {"erode": eroded, "dilate": dilated,
+                    "opening": morph_reference(eroded, height, width, False),
+                    "closing": morph_reference(dilated, height, width, True)}
+        for op, expected_pixels in expected.items():
+            result = getattr(micro_image, op)(height, width)
+            assert isinstance(result, MicroImageClass)
+            assert np.array_equal(decode(result), expected_pixels), (op, height, width)
+            assert result._ret_header_fields(result.processed)["num_pos_pix"] == expected_pixels.sum()
+
+
+@pytest.mark.parametrize("MicroImageClass", CODECS)
+def test_save_morphology_parasite(MicroImageClass, tmp_path, monkeypatch):
+    monkeypatch.setattr(cfg, "PROCESSED_DIR", str(tmp_path))
+    pixels = random_images()[0]
+    micro_image = make_image(MicroImageClass, pixels)
+    body, veins = micro_image.dilate(3, 3), micro_image.erode(3, 3) # no raw images to compare the sizes with
+    par = Parasite.from_micro_images("morph", body, veins)
+    par.save_data()
+    for kind, result in (("body", body), ("veins", veins)):
+        path = tmp_path / f"{par.saved_filenames[kind]}.npy"
+        assert MicroImageLarge.read_saved_header(path) == result.read_header()
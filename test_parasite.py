@@ -0,0 +1,135 @@
+from micro_image_large import ScanLinesMicroImage, BitMapMicroImage, VerticalDeltaMicroImage, SparseMicroImage, \
+    ScanLinesStreamMicroImage, BitMapStreamMicroImage
+from parasite import Parasite, ParasiteStream
+from results_index import ResultsIndex
+from work_queue import SQLiteWorkQueue, JobProducer
+import numpy as np
+from PIL import Image
+import pytest
+
+
+# Write a binary numpy as an image file the MicroImage processing techniques can read (0 positive, 255 background)
+def save_image(path, pixels):
+    Image.fromarray(((1 - pixels.astype(np.uint8)) * 255)).save(path)
+    return str(path)
+
+
+CODECS = [ScanLinesMicroImage, BitMapMicroImage, VerticalDeltaMicroImage, SparseMicroImage]
+
+
+# Body blob with vein strands, vein pixels within the body make up about frac of it
+def make_parasite(rng, frac):
+    rows, cols = 61, 83 # not a multiple of 8 pixels, so that the bitmap drops an incomplete last byte
+    yy, xx = np.mgrid[:rows, :cols]
+    body = (yy - 30) ** 2 / 28 ** 2 + (xx - 40) ** 2 / 38 ** 2 < 1
+    veins = rng.random((rows, cols)) < frac
+    veins[rng.integers(0, rows, 3)] = True # strands crossing the body edge
+    return body, veins
+
+
+@pytest.mark.parametrize("mode", ["exact", "early_exit", "approx"])
+@pytest.mark.parametrize("VeinsMicroImageClass", CODECS)
+@pytest.mark.parametrize("MicroImageClass", CODECS)
+def test_codec_pairings(tmp_path, MicroImageClass, VeinsMicroImageClass, mode):
+    rng = np.random.default_rng(0)
+    for case, frac in enumerate((0.03, 0.3)):
+        body, veins = make_parasite(rng, frac)
+        body_path = save_image(tmp_path / f"{case}_body.tiff", body)
+        veins_path = save_image(tmp_path / f"{case}_veins.tiff", veins)
+        if VeinsMicroImageClass not in (MicroImageClass, SparseMicroImage):
+            with pytest.raises(ValueError, match="can't be analysed"):
+                Parasite("test", body_path, veins_path, MicroImageClass, mode, VeinsMicroImageClass)
+            continue
+        expected = (body & veins).sum() / body.sum()
+        par = Parasite("test", body_path, veins_path, MicroImageClass, mode, VeinsMicroImageClass)
+        if mode == "exact":
+            assert par.veins_body_frac == pytest.approx(expected)
+        assert par.has_cancer() == (expected > 0.1)
+
+
+def test_unsupported_pairings_rejected_before_processing(tmp_path):
+    with pytest.raises(ValueError, match="can't be analysed"): # before the missing input images are read
+        ResultsIndex(str(tmp_path / "index.sqlite")).process_parasite("test", "nope_body.tiff", "nope_veins.tiff",
+                                                                      BitMapMicroImage, "exact", ScanLinesMicroImage)
+    queue = SQLiteWorkQueue(str(tmp_path / "queue.sqlite"))
+    with pytest.raises(ValueError, match="can't be analysed"):
+        JobProducer(queue).enqueue("test", "nope_body.tiff", "nope_veins.tiff", VerticalDeltaMicroImage, "exact",
+                                   BitMapMicroImage)
+    assert queue.counts()["pending"] == 0
+
+
+def test_index_rejects_stream_without_hashes(tmp_path):
+    pixels = np.where(np.random.default_rng(0).random((6, 8)) < 0.5, 0, 255).astype(np.uint8)
+    par = ParasiteStream("test", 6, 8, ScanLinesStreamMicroImage)
+    par.append_rows(pixels, pixels)
+    par.finalize()
+    index = ResultsIndex(str(tmp_path / "index.sqlite"))
+    with pytest.raises(ValueError, match="no body image file"):
+        index.add_parasite(par)
+    parasite_id = index.add_parasite(par, body_hash="body", veins_hash="veins")
+    assert index.query()[0]["num_body_pix"] == (pixels == 0).sum()
+    assert len(index.images(parasite_id)) == 2
+
+
+# Images ending on a positive pixel, with and without gaps longer than the ScanLines dtype, and one ending on background
+def stream_batch_images():
+    rng = np.random.default_rng(1)
+    noisy = rng.random((9, 13)) < 0.5
+    noisy[-1, -1] = True
+    full = np.ones((4, 6), dtype=bool)
+    long_last_run = np.zeros((3, 40000), dtype=bool)
+    long_last_run[0, 5:9], long_last_run[1, 100:] = True, True
+    long_gap = np.zeros((3, 40000), dtype=bool)
+    long_gap[0, 5:9], long_gap[2, -3:] = True, True
+    background_end = noisy.copy()
+    background_end[-1, -1] = False
+    return [noisy, full, long_last_run, long_gap, background_end]
+
+
+@pytest.mark.parametrize("image_idx", range(len(stream_batch_images())))
+@pytest.mark.parametrize("StreamMicroImageClass", [ScanLinesStreamMicroImage, BitMapStreamMicroImage])
+def test_stream_matches_batch(tmp_path, StreamMicroImageClass, image_idx):
+    pixels = stream_batch_images()[image_idx]
+    batch = StreamMicroImageClass.__bases__[1](save_image(tmp_path / "image.tiff", pixels))
+    stream = StreamMicroImageClass(*pixels.shape)
+    for row_start in range(0, pixels.shape[0], 2):
+        stream.append_rows(np.where(pixels[row_start:row_start + 2], 0, 255).astype(np.uint8))
+    assert np.array_equal(stream.finalize(), batch.processed)
+    if StreamMicroImageClass is ScanLinesStreamMicroImage: # the decoded runs hold every positive pixel of the header
+        starts, ends = batch._ret_runs(batch.processed)
+        assert (ends - starts).sum() == batch._count_body_pix() == pixels.sum()
+        assert np.array_equal(batch.decode_into(np.zeros(pixels.shape, dtype=bool)), pixels)
+        flat = np.concatenate(([0], pixels.reshape(-1).astype(np.int8), [0]))
+        switches = np.flatnonzero(np.diff(flat))
+        assert np.array_equal(batch._runs_to_processed(switches[0::2], switches[1::2], *pixels.shape), batch.processed)
+
+
+def test_approx_sparse_body_in_large_bbox(tmp_path):
+    pixels = np.zeros((1600, 1600), dtype=bool)
+    pixels[0, 0] = pixels[0, -1] = pixels[-1, 0] = pixels[-1, -1] = True # rejection sampling draws no body pixel
+    path = save_image(tmp_path / "body.tiff", pixels)
+    body = BitMapMicroImage(path)
+    assert body.estimate_veins_perc(body, seed=0) == (0.5, 0.0, 1.0)
+    par = Parasite("test", path, path, BitMapMicroImage, mode="approx")
+    assert par.veins_body_frac == 1.0
+    assert par.veins_body_frac_bounds[1] == 1.0 # (1, 1) unless a body pixel happened to be drawn
+    assert par.has_cancer()
+
+
+@pytest.mark.parametrize("StreamMicroImageClass", [ScanLinesStreamMicroImage, BitMapStreamMicroImage])
+def test_stream_rejects_mismatched_strips(StreamMicroImageClass, monkeypatch):
+    rng = np.random.default_rng(0)
+    body, veins = [np.where(rng.random((10, 12)) < 0.5, 0, 255).astype(np.uint8) for kind in range(2)]
+    par = ParasiteStream("test", 10, 12, StreamMicroImageClass)
+    par.append_rows(body[:3], veins[:3])
+    with pytest.raises(ValueError):
+        par.append_rows(body[3:7], veins[3:6])
+    assert par.body.rows_so_far == par.veins.rows_so_far == 3
+    with pytest.raises(ValueError, match="not finalized"):
+        par.show_image()
+    par.append_rows(body[3:], veins[3:])
+    body_pix, veins_pix = body == 0, veins == 0
+    assert par.finalize() == (body_pix & veins_pix).sum() / body_pix.sum()
+    import matplotlib.pyplot as plt
+    monkeypatch.setattr(plt, "show", lambda: None)
+    par.show_image()
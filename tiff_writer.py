@@ -0,0 +1,110 @@
+import numpy as np
+import struct
+
+
+'''
+StripedTiffWriter class writes an uncompressed single-image TIFF file strip by strip, so that only one strip of rows
+ever has to be in memory. The strips are written as they come, and the image file directory (the TIFF metadata) is
+written after them when the writer is closed. Images whose file would exceed 4GB are written as BigTIFF.
+'''
+class StripedTiffWriter():
+
+    # PhotometricInterpretation values: whether a 0 sample is white or black
+    WHITE_IS_ZERO = 0
+    BLACK_IS_ZERO = 1
+    # TIFF field types: (type code, struct format) of SHORT, LONG and LONG8 values
+    SHORT, LONG, LONG8 = (3, "H"), (4, "I"), (16, "Q")
+
+    # Initialize StripedTiffWriter object, creating the file and writing its header
+    # Parameters:
+    # path: path of the TIFF file to create
+    # rows, cols: number of rows and columns of the image
+    # bits_per_sample: 1 for a bilevel image (8 pixels per byte, most significant bit first, every row starting on a
+    #                  new byte), or 8 for a grayscale image
+    # rows_per_strip: number of rows of every strip but the last
+    # photometric: WHITE_IS_ZERO or BLACK_IS_ZERO
+    # bigtiff: whether to write a BigTIFF file, by default only if the file would be too large for a TIFF file
+    def __init__(self, path, rows, cols, bits_per_sample, rows_per_strip, photometric, bigtiff=None):
+        if bits_per_sample not in (1, 8):
+            raise ValueError(f"Bits per sample must be 1 or 8, not {bits_per_sample}")
+        self.rows, self.cols = rows, cols
+        self.bits_per_sample = bits_per_sample
+        self.rows_per_strip = max(1, min(rows_per_strip, rows))
+        self.photometric = photometric
+        self.row_nbytes = -(-cols * bits_per_sample // 8)
+        strip_rows = np.diff(np.append(np.arange(0, rows, self.rows_per_strip), rows))
+        self.strip_nbytes = strip_rows * self.row_nbytes
+        data_nbytes = int(self.strip_nbytes.sum())
+        self.bigtiff = data_nbytes + 2 * 8 * strip_rows.size + 1024 >= 1 << 32 if bigtiff is None else bigtiff
+        self.header_len = 16 if self.bigtiff else 8
+        self.strip_offsets = self.header_len + np.cumsum(self.strip_nbytes) - self.strip_nbytes
+        self.ifd_offset = self.header_len + data_nbytes + data_nbytes % 2 # the IFD has to start on a word boundary
+        self.num_strips_written = 0
+        self.file = open(path, "wb")
+        if self.bigtiff:
+            self.file.write(struct.pack("<2sHHHQ", b"II", 43, 8, 0, self.ifd_offset))
+        else:
+            self.file.write(struct.pack("<2sHI", b"II", 42, self.ifd_offset))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.file.close()
+
+    # Write the next strip of the image
+    # Parameters:
+    # strip: uint8 array of shape (number of rows of the strip, row_nbytes)
+    def write_strip(self, strip):
+        if self.num_strips_written == self.strip_nbytes.size:
+            raise ValueError("All the strips of the image were already written")
+        expected_shape = (self.strip_nbytes[self.num_strips_written] // self.row_nbytes, self.row_nbytes)
+        if strip.shape != expected_shape or strip.dtype != np.uint8:
+            raise ValueError(f"Strip {self.num_strips_written} must be a uint8 array of shape {expected_shape}")
+        self.file.write(np.ascontiguousarray(strip).data)
+        self.num_strips_written += 1
+
+    # Write the image file directory after the strips and close the file
+    def close(self):
+        if self.num_strips_written != self.strip_nbytes.size:
+            self.file.close()
+            raise ValueError(f"Only {self.num_strips_written} of the {self.strip_nbytes.size} strips were written")
+        offset_type = self.LONG8 if self.bigtiff else self.LONG
+        entries = [(256, self.LONG, [self.cols]), # ImageWidth
+                   (257, self.LONG, [self.rows]), # ImageLength
+                   (258, self.SHORT, [self.bits_per_sample]), # BitsPerSample
+                   (259, self.SHORT, [1]), # Compression: none
+                   (262, self.SHORT, [self.photometric]), # PhotometricInterpretation
+                   (273, offset_type, self.strip_offsets.tolist()), # StripOffsets
+                   (277, self.SHORT, [1]), # SamplesPerPixel
+                   (278, self.LONG, [self.rows_per_strip]), # RowsPerStrip
+                   (279, offset_type, self.strip_nbytes.tolist()), # StripByteCounts
+                   (284, self.SHORT, [1])] # PlanarConfiguration: chunky
+        self.file.write(b"\0" * (self.ifd_offset - self.file.tell()))
+        self.file.write(self._pack_ifd(entries))
+        self.file.close()
+
+    # Pack the image file directory: the number of entries, the entries, the offset of the next directory (none), and
+    # after it the values that don't fit in their entry
+    # Parameters:
+    # entries: list of (tag, field type, list of values), sorted by tag
+    def _pack_ifd(self, entries):
+        count_fmt, value_nbytes = ("<Q", 8) if self.bigtiff else ("<H", 4)
+        entry_fmt = "<HHQ" if self.bigtiff else "<HHI"
+        ifd = struct.pack(count_fmt, len(entries))
+        next_ifd = struct.pack("<Q" if self.bigtiff else "<I", 0)
+        out_of_line = b""
+        out_of_line_offset = self.ifd_offset + len(ifd) + len(entries) * (struct.calcsize(entry_fmt) + value_nbytes) + \
+            len(next_ifd)
+        for tag, (type_code, value_fmt), values in entries:
+            packed_values = struct.pack(f"<{len(values)}{value_fmt}", *values)
+            if len(packed_values) <= value_nbytes: # left-justified in the entry
+                value = packed_values.ljust(value_nbytes, b"\0")
+            else:
+                value = struct.pack("<Q" if self.bigtiff else "<I", out_of_line_offset + len(out_of_line))
+                out_of_line += packed_values + b"\0" * (len(packed_values) % 2)
+            ifd += struct.pack(entry_fmt, tag, type_code, len(values)) + value
+        return ifd + next_ifd + out_of_line
@@ -0,0 +1,169 @@
+import config as cfg
+import numpy as np
+import struct
+import zlib
+
+
+'''
+BinaryTransport class ships processed images between processes or machines as binary frames: a fixed-size frame header
+followed by the raw bytes of the processed image. Frames are sent straight from the memory of the processed image and
+parsed into NumPy arrays over the received buffer, so a processed image is never copied, re-encoded or inflated on the
+way. A CRC-32 of the payload can be added to the frame header and checked on arrival.
+'''
+class BinaryTransport():
+
+    # Frame header: magic bytes, format version, flags, NumPy type code of the processed image elements (e.g. "H" for
+    # uint16), payload size in bytes and CRC-32 of the payload. It is 24 bytes, so that the payload stays 8-byte aligned
+    # when frames are laid end to end
+    frame_header = struct.Struct("<4sBBcxQI4x")
+    FLAG_CHECKSUM = 1
+    # NumPy type codes of the processed image dtypes that can be sent
+    TYPE_CODES = {np.dtype(np.uint8): b"B", np.dtype(np.uint16): b"H"}
+
+    # Build the frame of a processed image without copying it
+    # Parameters:
+    # processed: the processed image, a 1-D uint8 or uint16 array
+    # checksum: whether to add a CRC-32 of the payload to the frame header
+    # Returns the frame header bytes and a memoryview of the payload, to be written one after the other
+    @classmethod
+    def pack_frame(cls, processed, checksum=True):
+        processed = np.ascontiguousarray(processed) # no copy if it already is
+        if processed.ndim != 1 or processed.dtype not in cls.TYPE_CODES:
+            raise ValueError("Only 1-D uint8 or uint16 processed images can be sent")
+        payload = memoryview(processed.astype(processed.dtype.newbyteorder("<"), copy=False)).cast("B")
+        crc = zlib.crc32(payload) if checksum else 0
+        header = cls.frame_header.pack(cfg.TRANSPORT_MAGIC, cfg.TRANSPORT_VERSION,
+                                       cls.FLAG_CHECKSUM if checksum else 0, cls.TYPE_CODES[processed.dtype],
+                                       payload.nbytes, crc)
+        return header, payload
+
+    # Build the frame of a processed image as a single bytearray (one copy of the payload), e.g. to put it in a queue
+    # Parameters:
+    # processed, checksum: see pack_frame
+    @classmethod
+    def frame_to_bytes(cls, processed, checksum=True):
+        header, payload = cls.pack_frame(processed, checksum)
+        frame = bytearray(len(header) + payload.nbytes)
+        frame[:len(header)] = header
+        frame[len(header):] = payload
+        return frame
+
+    # Parse a frame header
+    # Parameters:
+    # header: the frame header bytes
+    # Returns the dtype, payload size in bytes, and CRC-32 of the payload (None if the frame has no checksum)
+    @classmethod
+    def _parse_header(cls, header):
+        magic, version, flags, type_code, payload_nbytes, crc = cls.frame_header.unpack(header)
+        if magic != cfg.TRANSPORT_MAGIC:
+            raise ValueError("Not a processed image frame")
+        if version != cfg.TRANSPORT_VERSION:
+            raise ValueError(f"Unsupported frame version: {version}")
+        dtype = np.dtype(type_code.decode()).newbyteorder("<")
+        return dtype, payload_nbytes, crc if flags & cls.FLAG_CHECKSUM else None
+
+    # Check the checksum of a payload, if the frame has one
+    @staticmethod
+    def _verify(payload, crc):
+        if crc is not None and zlib.crc32(payload) != crc:
+            raise ValueError("Processed image frame is corrupted: checksum mismatch")
+
+    # Parse a frame without copying its payload
+    # Parameters:
+    # buffer: bytes-like object holding the frame (and possibly more frames after it)
+    # offset: where the frame starts in buffer
+    # verify: whether to check the checksum of the payload, if the frame has one
+    # Returns the processed image, a read-only array over buffer if buffer is read-only, and the offset of the end of
+    # the frame in buffer
+    @classmethod
+    def unpack_frame(cls, buffer, offset=0, verify=True):
+        buffer = memoryview(buffer).cast("B")
+        header_end = offset + cls.frame_header.size
+        if buffer.nbytes < header_end:
+            raise ValueError("Processed image frame is truncated")
+        dtype, payload_nbytes, crc = cls._parse_header(buffer[offset:header_end])
+        frame_end = header_end + payload_nbytes
+        if buffer.nbytes < frame_end:
+            raise ValueError("Processed image frame is truncated")
+        payload = buffer[header_end:frame_end]
+        if verify:
+            cls._verify(payload, crc)
+        return np.frombuffer(payload, dtype=dtype), frame_end
+
+    # Send a processed image over a connected stream socket, with a single system call when possible
+    # Parameters:
+    # sock: the socket
+    # processed, checksum: see pack_frame
+    @classmethod
+    def send(cls, sock, processed, checksum=True):
+        header, payload = cls.pack_frame(processed, checksum)
+        sent = sock.sendmsg([header, payload])
+        if sent < len(header): # partial sends are rare, send the rest the plain way
+            sock.sendall(header[sent:])
+            sent = len(header)
+        if sent - len(header) < payload.nbytes:
+            sock.sendall(payload[sent - len(header):])
+
+    # Receive a processed image sent with send, straight into the buffer of the returned array
+    # Parameters:
+    # sock: the socket
+    # verify: see unpack_frame
+    # Returns the processed image, or None if the connection was closed before a new frame
+    @classmethod
+    def recv(cls, sock, verify=True):
+        header = bytearray(cls.frame_header.size)
+        if not cls._recv_exactly(sock, memoryview(header), eof_ok=True):
+            return None
+        dtype, payload_nbytes, crc = cls._parse_header(header)
+        payload = bytearray(payload_nbytes)
+        cls._recv_exactly(sock, memoryview(payload))
+        if verify:
+            cls._verify(payload, crc)
+        return np.frombuffer(payload, dtype=dtype)
+
+    # Fill a buffer from a socket
+    # Parameters:
+    # sock: the socket
+    # view: memoryview of the buffer to fill
+    # eof_ok: whether the connection may be closed before the first byte, in which case False is returned
+    @staticmethod
+    def _recv_exactly(sock, view, eof_ok=False):
+        received = 0
+        while received < view.nbytes:
+            num_bytes = sock.recv_into(view[received:])
+            if num_bytes == 0:
+                if eof_ok and received == 0:
+                    return False
+                raise ConnectionError("Connection closed in the middle of a processed image frame")
+            received += num_bytes
+        return True
+
+    # Write the frame of a processed image to a binary file (e.g. a pipe)
+    # Parameters:
+    # outfile: the binary file
+    # processed, checksum: see pack_frame
+    @classmethod
+    def write(cls, outfile, processed, checksum=True):
+        header, payload = cls.pack_frame(processed, checksum)
+        outfile.write(header)
+        outfile.write(payload)
+
+    # Read the frame of a processed image from a binary file, straight into the buffer of the returned array
+    # Parameters:
+    # infile: the binary file
+    # verify: see unpack_frame
+    # Returns the processed image, or None at the end of the file
+    @classmethod
+    def read(cls, infile, verify=True):
+        header = infile.read(cls.frame_header.size)
+        if not header:
+            return None
+        if len(header) < cls.frame_header.size:
+            raise ValueError("Processed image frame is truncated")
+        dtype, payload_nbytes, crc = cls._parse_header(header)
+        payload = bytearray(payload_nbytes)
+        if infile.readinto(payload) != payload_nbytes:
+            raise ValueError("Processed image frame is truncated")
+        if verify:
+            cls._verify(payload, crc)
+        return np.frombuffer(payload, dtype=dtype)
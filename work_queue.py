@@ -0,0 +1,361 @@
+from micro_image_large import CODECS
+from parasite import Parasite
+import config as cfg
+from contextlib import contextmanager
+import json
+import os
+import socket
+import sqlite3
+import sys
+import threading
+import time
+
+
+'''
+WorkQueue class is the interface between the producers that enqueue parasite jobs (body image, veins image, processing
+technique) and the workers, on any node, that claim them, process and analyse the parasite and publish the results.
+A claimed job is leased to its worker, which has to renew the lease with heartbeats while it runs the job: the job of a
+worker that died is claimed again by another worker once its lease expires.
+Jobs and results are dicts, see SQLiteWorkQueue.JOBS_SCHEMA for their fields.
+'''
+class WorkQueue():
+
+    # Add a job to the queue
+    # Parameters:
+    # job: dict with the sess_name, body_img_path, veins_img_path, codec, veins_codec (or None) and mode of the job
+    # Returns the id of the job
+    def put(self, job):
+        raise NotImplementedError
+
+    # Claim the oldest job that is waiting, or whose worker stopped renewing its lease
+    # Parameters:
+    # worker_id: id of the claiming worker
+    # Returns the job as a dict (with its "id" and "attempts"), or None if there is nothing to do
+    def claim(self, worker_id):
+        raise NotImplementedError
+
+    # Renew the lease of a running job
+    # Parameters:
+    # job_id: id of the job
+    # worker_id: id of the worker running the job
+    # Returns False if the job is not leased to this worker anymore
+    def heartbeat(self, job_id, worker_id):
+        raise NotImplementedError
+
+    # Publish the result of a job
+    # Parameters:
+    # job_id, worker_id: see heartbeat
+    # result: JSON serializable dict
+    # Returns False if the job is not leased to this worker anymore, in which case the result is dropped
+    def complete(self, job_id, worker_id, result):
+        raise NotImplementedError
+
+    # Report that a job failed. It is put back in the queue unless it ran out of attempts
+    # Parameters:
+    # job_id, worker_id: see heartbeat
+    # error: description of the error
+    # Returns False if the job is not leased to this worker anymore
+    def fail(self, job_id, worker_id, error):
+        raise NotImplementedError
+
+    # Get the jobs of the queue
+    # Parameters:
+    # status: only return the jobs with this status ("pending", "running", "done" or "failed")
+    def jobs(self, status=None):
+        raise NotImplementedError
+
+    # Number of jobs of the queue per status
+    def counts(self):
+        raise NotImplementedError
+
+'''
+SQLiteWorkQueue class is a WorkQueue kept in a local SQLite database file. Every call is a short transaction of its
+own, so the same database can be used by any number of processes, or of nodes if it is on a filesystem whose locks
+SQLite can rely on. Other backends (e.g. a message broker) only need to implement the WorkQueue methods.
+'''
+class SQLiteWorkQueue(WorkQueue):
+
+    # One row per job
+    JOBS_SCHEMA = """
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY,
+            sess_name TEXT NOT NULL,
+            body_img_path TEXT NOT NULL,
+            veins_img_path TEXT NOT NULL,
+            codec TEXT NOT NULL,
+            veins_codec TEXT,
+            mode TEXT NOT NULL,
+            status TEXT NOT NULL,
+            worker_id TEXT,
+            lease_expires REAL,
+            attempts INTEGER NOT NULL,
+            result TEXT,
+            error TEXT,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL
+        )"""
+    INDEXES = [
+        "CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, id)",
+    ]
+
+    # Initialize SQLiteWorkQueue object, creating the database if needed
+    # Parameters:
+    # db_path: path to the SQLite database file
+    # lease_secs: how long a claimed job stays leased to its worker without a heartbeat
+    # max_attempts: number of times a job is claimed before it's marked as failed
+    def __init__(self, db_path=cfg.WORK_QUEUE_PATH, lease_secs=cfg.WORK_QUEUE_LEASE_SECS,
+                 max_attempts=cfg.WORK_QUEUE_MAX_ATTEMPTS):
+        self.db_path = db_path
+        self.lease_secs = lease_secs
+        self.max_attempts = max_attempts
+        with self._transaction() as conn:
+            conn.execute(self.JOBS_SCHEMA)
+            for index in self.INDEXES:
+                conn.execute(index)
+
+    # Open a connection to the database and run a write transaction on it, locking out the other processes until the
+    # transaction ends
+    @contextmanager
+    def _transaction(self):
+        conn = sqlite3.connect(self.db_path, timeout=cfg.WORK_QUEUE_DB_TIMEOUT_SECS, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            yield conn
+            conn.execute("COMMIT")
+        except BaseException:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+    # Turn a jobs row into a job dict
+    @staticmethod
+    def _row_to_job(row):
+        job = dict(row)
+        job["result"] = json.loads(job["result"]) if job["result"] is not None else None
+        return job
+
+    def put(self, job):
+        now = time.time()
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                "INSERT INTO jobs (sess_name, body_img_path, veins_img_path, codec, veins_codec, mode, status, "
+                "attempts, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, 'pending', 0, ?, ?)",
+                (job["sess_name"], job["body_img_path"], job["veins_img_path"], job["codec"], job.get("veins_codec"),
+                 job.get("mode", "exact"), now, now))
+            return cursor.lastrowid
+
+    def claim(self, worker_id):
+        now = time.time()
+        with self._transaction() as conn:
+            # the jobs whose worker died on their last attempt are given up on
+            conn.execute("UPDATE jobs SET status = 'failed', error = 'lease expired', updated_at = ? "
+                         "WHERE status = 'running' AND lease_expires < ? AND attempts >= ?",
+                         (now, now, self.max_attempts))
+            row = conn.execute("SELECT * FROM jobs WHERE status = 'pending' OR "
+                               "(status = 'running' AND lease_expires < ?) ORDER BY id LIMIT 1", (now,)).fetchone()
+            if row is None:
+                return None
+            conn.execute("UPDATE jobs SET status = 'running', worker_id = ?, lease_expires = ?, "
+                         "attempts = attempts + 1, updated_at = ? WHERE id = ?",
+                         (worker_id, now + self.lease_secs, now, row["id"]))
+            job = self._row_to_job(row)
+        job.update(status="running", worker_id=worker_id, attempts=job["attempts"] + 1)
+        return job
+
+    def heartbeat(self, job_id, worker_id):
+        now = time.time()
+        with self._transaction() as conn:
+            cursor = conn.execute("UPDATE jobs SET lease_expires = ?, updated_at = ? "
+                                  "WHERE id = ? AND worker_id = ? AND status = 'running'",
+                                  (now + self.lease_secs, now, job_id, worker_id))
+            return cursor.rowcount == 1
+
+    def complete(self, job_id, worker_id, result):
+        with self._transaction() as conn:
+            cursor = conn.execute("UPDATE jobs SET status = 'done', result = ?, error = NULL, lease_expires = NULL, "
+                                  "updated_at = ? WHERE id = ? AND worker_id = ? AND status = 'running'",
+                                  (json.dumps(result), time.time(), job_id, worker_id))
+            return cursor.rowcount == 1
+
+    def fail(self, job_id, worker_id, error):
+        with self._transaction() as conn:
+            cursor = conn.execute("UPDATE jobs SET status = CASE WHEN attempts < ? THEN 'pending' ELSE 'failed' END, "
+                                  "error = ?, lease_expires = NULL, updated_at = ? "
+                                  "WHERE id = ? AND worker_id = ? AND status = 'running'",
+                                  (self.max_attempts, error, time.time(), job_id, worker_id))
+            return cursor.rowcount == 1
+
+    def jobs(self, status=None):
+        with self._transaction() as conn:
+            if status is None:
+                rows = conn.execute("SELECT * FROM jobs ORDER BY id").fetchall()
+            else:
+                rows = conn.execute("SELECT * FROM jobs WHERE status = ? ORDER BY id", (status,)).fetchall()
+        return [self._row_to_job(row) for row in rows]
+
+    def counts(self):
+        with self._transaction() as conn:
+            rows = conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        counts = {"pending": 0, "running": 0, "done": 0, "failed": 0}
+        counts.update({status: num for status, num in rows})
+        return counts
+
+'''
+JobProducer class enqueues parasite jobs in a WorkQueue
+'''
+class JobProducer():
+
+    # Initialize JobProducer object
+    # Parameters:
+    # queue: the WorkQueue to enqueue the jobs in
+    def __init__(self, queue):
+        self.queue = queue
+
+    # Enqueue the processing and analysis of a parasite
+    # Parameters:
+    # sess_name, body_img_path, veins_img_path, MicroImageClass, mode, VeinsMicroImageClass: see Parasite
+    # Returns the id of the job
+    def enqueue(self, sess_name, body_img_path, veins_img_path, MicroImageClass, mode="exact",
+                VeinsMicroImageClass=None):
+        for MIClass in (MicroImageClass, VeinsMicroImageClass or MicroImageClass):
+            if CODECS.get(MIClass.name) is not MIClass:
+                raise ValueError(f"Jobs can't be run with {MIClass.__name__}")
+        Parasite.check_codecs(MicroImageClass, VeinsMicroImageClass) # rather than failing in the worker
+        return self.queue.put({"sess_name": sess_name, "body_img_path": body_img_path,
+                               "veins_img_path": veins_img_path, "codec": MicroImageClass.name,
+                               "veins_codec": VeinsMicroImageClass.name if VeinsMicroImageClass else None,
+                               "mode": mode})
+
+    # Enqueue every parasite of a directory of collected images, i.e. every {name}_body.{ext} image that has a
+    # {name}_veins.{ext} image next to it. The session name of a parasite is its {name}
+    # Parameters:
+    # MicroImageClass, mode, VeinsMicroImageClass: see Parasite
+    # collected_dir: the directory of collected images
+    # Returns the ids of the jobs
+    def enqueue_collected(self, MicroImageClass, mode="exact", VeinsMicroImageClass=None,
+                          collected_dir=cfg.COLLECTED_DIR):
+        job_ids = []
+        for filename in sorted(os.listdir(collected_dir)):
+            name, ext = os.path.splitext(filename)
+            if not name.endswith("_body"):
+                continue
+            sess_name = name[:-len("_body")]
+            veins_img_path = os.path.join(collected_dir, f"{sess_name}_veins{ext}")
+            if os.path.exists(veins_img_path):
+                job_ids.append(self.enqueue(sess_name, os.path.join(collected_dir, filename), veins_img_path,
+                                            MicroImageClass, mode, VeinsMicroImageClass))
+        return job_ids
+
+    # Wait until no job is waiting or running anymore
+    # Parameters:
+    # poll_secs: how long to wait between two checks of the queue
+    # Returns the number of jobs per status
+    def wait(self, poll_secs=cfg.WORK_QUEUE_POLL_SECS):
+        while True:
+            counts = self.queue.counts()
+            if counts["pending"] == 0 and counts["running"] == 0:
+                return counts
+            time.sleep(poll_secs)
+
+'''
+Worker class claims parasite jobs from a WorkQueue, processes and analyses the parasites, saves the processed images
+and publishes the results back to the queue. Any number of workers can share a queue. While a job runs, a background
+thread renews its lease every cfg.WORK_QUEUE_HEARTBEAT_SECS.
+'''
+class Worker():
+
+    # Initialize Worker object
+    # Parameters:
+    # queue: the WorkQueue to claim jobs from
+    # worker_id: id of the worker, defaults to {host name}:{process id}
+    # results_index: ResultsIndex in which to also record the processed parasites, if any
+    # heartbeat_secs: how often to renew the lease of the running job
+    def __init__(self, queue, worker_id=None, results_index=None, heartbeat_secs=cfg.WORK_QUEUE_HEARTBEAT_SECS):
+        self.queue = queue
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+        self.results_index = results_index
+        self.heartbeat_secs = heartbeat_secs
+
+    # Claim and run jobs
+    # Parameters:
+    # max_jobs: stop after this many jobs, never stops by default
+    # stop_when_empty: stop as soon as there is no job to claim instead of waiting for new ones
+    # poll_secs: how long to wait before looking for a job again when there is none
+    # Returns the number of jobs run
+    def run(self, max_jobs=None, stop_when_empty=False, poll_secs=cfg.WORK_QUEUE_POLL_SECS):
+        num_jobs = 0
+        while max_jobs is None or num_jobs < max_jobs:
+            if self.run_one() is not None:
+                num_jobs += 1
+            elif stop_when_empty:
+                break
+            else:
+                time.sleep(poll_secs)
+        return num_jobs
+
+    # Claim and run one job
+    # Returns the id of the job, or None if there was no job to claim
+    def run_one(self):
+        job = self.queue.claim(self.worker_id)
+        if job is None:
+            return None
+        stop = threading.Event()
+        heartbeat = threading.Thread(target=self._keep_lease, args=(job["id"], stop), daemon=True)
+        heartbeat.start()
+        try:
+            result = self._run_job(job)
+        except Exception as e:
+            self.queue.fail(job["id"], self.worker_id, f"{type(e).__name__}: {e}")
+        else:
+            self.queue.complete(job["id"], self.worker_id, result)
+        finally:
+            stop.set()
+            heartbeat.join()
+        return job["id"]
+
+    # Renew the lease of a job until stop is set, or until the job isn't leased to this worker anymore
+    # Parameters:
+    # job_id: id of the job
+    # stop: threading.Event set once the job is over
+    def _keep_lease(self, job_id, stop):
+        while not stop.wait(self.heartbeat_secs):
+            if not self.queue.heartbeat(job_id, self.worker_id):
+                break
+
+    # Process, analyse and save a parasite
+    # Parameters:
+    # job: the claimed job
+    # Returns the result of the job
+    def _run_job(self, job):
+        par = Parasite(job["sess_name"], job["body_img_path"], job["veins_img_path"], CODECS[job["codec"]],
+                       mode=job["mode"], VeinsMicroImageClass=CODECS[job["veins_codec"]] if job["veins_codec"] else None)
+        par.save_data()
+        if self.results_index is not None:
+            self.results_index.add_parasite(par)
+        return {"veins_body_frac": None if par.veins_body_frac is None else float(par.veins_body_frac),
+                "has_cancer": bool(par.has_cancer()),
+                "body_processed_filename": par.processed_filename("body"),
+                "veins_processed_filename": par.processed_filename("veins"),
+                "worker_id": self.worker_id}
+
+if __name__=="__main__":
+
+    # python work_queue.py produce {codec}: enqueue every parasite of cfg.COLLECTED_DIR and wait for the results
+    # python work_queue.py work: run a worker until it's stopped
+    if sys.argv[1:2] == ["produce"] and (len(sys.argv) < 3 or sys.argv[2] not in CODECS):
+        print(f"Usage: python work_queue.py produce {{{'|'.join(CODECS)}}}")
+        print("       python work_queue.py work")
+        sys.exit(1)
+    queue = SQLiteWorkQueue()
+    if sys.argv[1:2] == ["produce"]:
+        producer = JobProducer(queue)
+        print("Enqueued jobs:", len(producer.enqueue_collected(CODECS[sys.argv[2]])))
+        print("Jobs per status:", producer.wait())
+        for job in queue.jobs("done"):
+            print(job["sess_name"], "Veins to Body %:", job["result"]["veins_body_frac"] * 100,
+                  "Has cancer:", job["result"]["has_cancer"])
+    else:
+        Worker(queue).run()